@@ -0,0 +1,483 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import socket
+import subprocess
+import tempfile
+import threading
+import re
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Offline benchmark for git-cloner.py: the tool is run against a local stub
+# of the GitHub API and a local git daemon serving synthetic repositories
+
+parser = argparse.ArgumentParser(prog="git-archv-bench", description="Benchmark git-cloner.py offline against a fake GitHub API and git daemon.")
+parser.add_argument('--scenarios', type=str, default='100,1000,10000', help="Comma-separated numbers of starred repositories to simulate")
+parser.add_argument('--seed-repos', type=int, default=20, help="Number of distinct synthetic upstream repositories")
+parser.add_argument('--fork-ratio', type=float, default=0.3, help="Fraction of synthetic repositories that are forks of another one")
+parser.add_argument('--max-repo-size', type=int, default=2048, help="Largest synthetic repository in KB")
+parser.add_argument('--latency', type=int, default=20, help="Latency added to every API response in milliseconds")
+parser.add_argument('--per-page', type=int, default=100, help="Maximum page size of the stub listing")
+parser.add_argument('--rate-limit', type=int, default=5000, help="Hourly rate limit reported by the stub API")
+parser.add_argument('--transport', choices=['git', 'file'], default='git', help="Serve repositories through git daemon or file:// URLs (git bytes are only measured with git daemon)")
+parser.add_argument('--workdir', type=str, help="Directory for seeds and archives (default: a temporary directory)")
+parser.add_argument('--keep', action='store_true', help="Keep the work directory after the run")
+parser.add_argument('--json', type=str, help="Also write the results as JSON to this file")
+parser.add_argument('--seed', type=int, default=1, help="Random seed for the synthetic repositories")
+parser.add_argument('tool_args', nargs=argparse.REMAINDER, help="Arguments passed to git-cloner.py after '--'")
+
+args = parser.parse_args()
+
+TOOL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'git-cloner.py')
+REAL_GIT = shutil.which('git')
+# Lines in the tool's output that mean it crashed, whatever its exit code
+CRASH_MARKERS = ('Sorry, something went wrong', 'Traceback (most recent call last)')
+
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@localhost',
+               GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@localhost')
+LANGUAGES = ['Python', 'C', 'Go', 'Rust', 'JavaScript', None]
+
+def git(*command, cwd=None):
+    subprocess.run([REAL_GIT, *command], cwd=cwd, env=GIT_ENV, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def write_commit(work_dir, size, message):
+    # Random content does not compress, so the byte counts stay meaningful
+    with open(os.path.join(work_dir, f"{message}.bin"), 'wb') as file:
+        file.write(random.randbytes(size))
+    git('add', '.', cwd=work_dir)
+    git('commit', '--quiet', '-m', message, cwd=work_dir)
+
+def seed_repos(seed_dir):
+    # Create bare base repositories of varying size and forks that share
+    # most of their history with a base repository
+    random.seed(args.seed)
+    work_root = os.path.join(seed_dir, '.work')
+    seeds = []
+    num_forks = int(args.seed_repos * args.fork_ratio)
+    num_bases = max(1, args.seed_repos - num_forks)
+
+    for n in range(num_bases):
+        work_dir = os.path.join(work_root, f"base{n}")
+        os.makedirs(work_dir)
+        git('init', '--quiet', '-b', 'main', cwd=work_dir)
+        size_kb = random.randint(4, args.max_repo_size)
+        for commit in range(3):
+            write_commit(work_dir, size_kb * 1024 // 3, f"commit{commit}")
+        git('clone', '--quiet', '--bare', work_dir, os.path.join(seed_dir, f"base{n}.git"))
+        seeds.append({'name': f"base{n}", 'size': size_kb, 'parent': None})
+
+    for n in range(num_forks):
+        parent = seeds[n % num_bases]
+        work_dir = os.path.join(work_root, f"fork{n}")
+        git('clone', '--quiet', os.path.join(seed_dir, f"{parent['name']}.git"), work_dir)
+        extra_kb = random.randint(1, 64)
+        write_commit(work_dir, extra_kb * 1024, 'fork')
+        git('clone', '--quiet', '--bare', work_dir, os.path.join(seed_dir, f"fork{n}.git"))
+        seeds.append({'name': f"fork{n}", 'size': parent['size'] + extra_kb, 'parent': parent['name']})
+
+    shutil.rmtree(work_root)
+    return seeds
+
+class CountingProxy:
+    """TCP proxy in front of git daemon counting the bytes it serves. Git
+    prints no byte count for fetches small enough to be unpacked, so the
+    transfer is measured on the wire instead of from the tool's output."""
+
+    def __init__(self, target_port):
+        self.target_port = target_port
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(64)
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.sock.getsockname()[1]
+
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.relay, args=(client,), daemon=True).start()
+
+    def relay(self, client):
+        try:
+            upstream = socket.create_connection(('127.0.0.1', self.target_port))
+        except OSError:
+            client.close()
+            return
+        requests = threading.Thread(target=self.pump, args=(client, upstream, False), daemon=True)
+        requests.start()
+        self.pump(upstream, client, True)
+        requests.join()
+        upstream.close()
+        client.close()
+
+    def pump(self, source, destination, counted):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                destination.sendall(data)
+                if counted:
+                    with self.lock:
+                        self.bytes_sent += len(data)
+        except OSError:
+            pass
+        finally:
+            # Pass the end of the stream on, the other direction may still be open
+            try:
+                destination.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def take_bytes(self):
+        with self.lock:
+            bytes_sent, self.bytes_sent = self.bytes_sent, 0
+        return bytes_sent
+
+    def close(self):
+        self.sock.close()
+
+def start_git_daemon(seed_dir):
+    port = get_free_port()
+    daemon = subprocess.Popen([REAL_GIT, 'daemon', '--reuseaddr', '--export-all', '--informative-errors',
+                               f'--base-path={seed_dir}', '--listen=127.0.0.1', f'--port={port}', seed_dir],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    proxy = CountingProxy(port)
+    return daemon, proxy, f"git://127.0.0.1:{proxy.port}"
+
+def make_listing(count, seeds, git_base):
+    listing = []
+    for i in range(count):
+        seed = seeds[i % len(seeds)]
+        listing.append({
+            'id': i + 1,
+            'full_name': f"user{i % 97}/repo{i}",
+            'clone_url': f"{git_base}/{seed['name']}.git",
+            'language': LANGUAGES[i % len(LANGUAGES)],
+            'size': seed['size'],
+            'owner': {'login': f"user{i % 97}"},
+            'has_wiki': i % 10 == 0,
+            'fork': seed['parent'] is not None,
+            'pushed_at': '2024-01-01T00:00:00Z',
+            'updated_at': '2024-01-01T00:00:00Z',
+            'default_branch': 'main',
+            'archived': False,
+            'disabled': False,
+        })
+    return listing
+
+class StubGitHub(ThreadingHTTPServer):
+    """Fake GitHub API serving a fixed starred listing with Link pagination,
+    ETags, rate-limit headers and a GraphQL endpoint for repository metadata."""
+
+    daemon_threads = True
+
+    def __init__(self, listing, seeds, git_base):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.listing = listing
+        self.by_name = {repo['full_name']: repo for repo in listing}
+        self.seeds = {seed['name']: seed for seed in seeds}
+        self.git_base = git_base
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.calls = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self.remaining = args.rate_limit
+        self.reset_at = int(time.time()) + 3600
+        self.missing_fields = set()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *log_args):
+        pass
+
+    def reply(self, status, body=b'', headers=None):
+        server = self.server
+        with server.lock:
+            server.calls += 1
+            server.bytes_sent += len(body)
+            if status != 304:
+                server.remaining = max(0, server.remaining - 1)
+            remaining = server.remaining
+        time.sleep(args.latency / 1000)
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('X-RateLimit-Limit', str(args.rate_limit))
+        self.send_header('X-RateLimit-Remaining', str(remaining))
+        self.send_header('X-RateLimit-Reset', str(server.reset_at))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_json(self, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            with self.server.lock:
+                self.server.not_modified += 1
+            return self.reply(304, headers={'ETag': etag})
+        headers = dict(headers or {}, ETag=etag)
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        self.reply(200, body, headers)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        if len(parts) == 3 and parts[0] == 'users' and parts[2] == 'starred':
+            per_page = min(int(query.get('per_page', ['30'])[0]), args.per_page)
+            page = int(query.get('page', ['1'])[0])
+            listing = self.server.listing
+            last_page = max(1, (len(listing) + per_page - 1) // per_page)
+            base = f"{self.server.url}{url.path}?per_page={per_page}&page="
+            links = []
+            if page < last_page:
+                links.append(f'<{base}{page + 1}>; rel="next"')
+                links.append(f'<{base}{last_page}>; rel="last"')
+            return self.reply_json(listing[(page - 1) * per_page:page * per_page], {'Link': ', '.join(links)} if links else None)
+        if len(parts) == 3 and parts[0] == 'repos':
+            repo = self.server.by_name.get(f"{parts[1]}/{parts[2]}")
+            if repo:
+                return self.reply_json(repo)
+        self.reply(404, b'{"message": "Not Found"}')
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip('/') != '/graphql':
+            return self.reply(404, b'{"message": "Not Found"}')
+        query = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))['query']
+        data = {}
+        for line in query.splitlines():
+            if ': repository(owner: ' not in line:
+                continue
+            alias = line.split(':', 1)[0].strip()
+            owner = line.split('owner: ', 1)[1].split(',', 1)[0]
+            name = line.split('name: ', 1)[1].split(')', 1)[0]
+            repo = self.server.by_name.get(f"{json.loads(owner)}/{json.loads(name)}")
+            data[alias] = repo and self.repo_metadata(repo)
+            if repo:
+                # The stub must serve every field the tool asks for
+                missing = get_requested_fields(query) - set(data[alias])
+                if missing:
+                    with self.server.lock:
+                        self.server.missing_fields |= missing
+        self.reply_json({'data': data})
+
+    def repo_metadata(self, repo):
+        seed = self.server.seeds[repo['clone_url'].rsplit('/', 1)[-1][:-len('.git')]]
+        parent = None
+        if seed['parent']:
+            parent = {'nameWithOwner': f"upstream/{seed['parent']}", 'url': f"{self.server.git_base}/{seed['parent']}"}
+        return {
+            'databaseId': repo['id'],
+            'nameWithOwner': repo['full_name'],
+            'url': repo['clone_url'][:-len('.git')],
+            'primaryLanguage': {'name': repo['language']} if repo['language'] else None,
+            'updatedAt': repo['updated_at'],
+            'hasWikiEnabled': repo['has_wiki'],
+            'defaultBranchRef': {'name': repo['default_branch']},
+            'pushedAt': repo['pushed_at'],
+            'diskUsage': repo['size'],
+            'isArchived': repo['archived'],
+            'isDisabled': repo['disabled'],
+            'isFork': repo['fork'],
+            'parent': parent,
+        }
+
+def get_requested_fields(query):
+    # Top-level fields of the repository fragment in a GraphQL query
+    fields = set()
+    depth = 0
+    start = query.find('{', query.find('fragment'))
+    for token in re.findall(r'[{}]|\w+', query[start:]):
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if depth == 0:
+                break
+        elif depth == 1:
+            fields.add(token)
+    return fields
+
+def find_crash(log_file, offset):
+    # First crash marker the tool wrote to its log since offset
+    with open(log_file, 'r', errors='replace') as file:
+        file.seek(offset)
+        for line in file:
+            if any(marker in line for marker in CRASH_MARKERS):
+                return line.strip()
+    return None
+
+def get_tree_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def run_tool(server, proxy, archive_dir, shim_dir, log_file):
+    git_log = os.path.join(shim_dir, 'calls.log')
+    if os.path.exists(git_log):
+        os.remove(git_log)
+    env = dict(os.environ, PATH=f"{shim_dir}{os.pathsep}{os.environ.get('PATH', '')}", BENCH_GIT_LOG=git_log)
+    tool_args = [arg for arg in args.tool_args if arg != '--']
+    command = [sys.executable, TOOL, '--token', 'bench', '--username', 'bench', '--api-url', server.url] + tool_args
+
+    server.reset_counters()
+    if proxy is not None:
+        proxy.take_bytes()
+    started = time.monotonic()
+    log_offset = os.path.getsize(log_file) if os.path.exists(log_file) else 0
+    with open(log_file, 'a') as log:
+        process = subprocess.Popen(command, cwd=archive_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.monotonic() - started
+
+    subprocesses = 0
+    if os.path.exists(git_log):
+        with open(git_log, 'r') as file:
+            subprocesses = sum(1 for _ in file)
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return {
+        'exit_code': os.waitstatus_to_exitcode(status),
+        'crash': find_crash(log_file, log_offset),
+        'missing_fields': sorted(server.missing_fields),
+        'wall_time': round(wall_time, 2),
+        'api_calls': server.calls,
+        'api_not_modified': server.not_modified,
+        'api_bytes': server.bytes_sent,
+        'git_bytes': proxy.take_bytes() if proxy is not None else None,
+        'subprocesses': subprocesses,
+        'peak_rss': peak_rss,
+        'archive_bytes': get_tree_size(archive_dir),
+    }
+
+def print_results(results):
+    columns = ['stars', 'run', 'exit', 'wall s', 'API calls', '304s', 'API MiB', 'git MiB', 'git procs', 'RSS MiB', 'archive MiB']
+    rows = []
+    for result in results:
+        rows.append([
+            str(result['stars']), result['run'], str(result['exit_code']), f"{result['wall_time']:.2f}",
+            str(result['api_calls']), str(result['api_not_modified']), f"{result['api_bytes'] / 1048576:.2f}",
+            f"{result['git_bytes'] / 1048576:.2f}" if result['git_bytes'] is not None else '-', str(result['subprocesses']), f"{result['peak_rss'] / 1048576:.1f}",
+            f"{result['archive_bytes'] / 1048576:.1f}",
+        ])
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
+
+def main():
+    work_dir = args.workdir or tempfile.mkdtemp(prefix='git-cloner-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+    seed_dir = os.path.join(work_dir, 'seeds')
+    shim_dir = os.path.join(work_dir, 'shim')
+    daemon = None
+    proxy = None
+    results = []
+    try:
+        print(f"Seeding {args.seed_repos} synthetic repositories in {seed_dir}...")
+        if os.path.exists(seed_dir):
+            shutil.rmtree(seed_dir)
+        os.makedirs(seed_dir)
+        seeds = seed_repos(seed_dir)
+
+        # Count the git processes the tool starts through a PATH shim
+        os.makedirs(shim_dir, exist_ok=True)
+        shim = os.path.join(shim_dir, 'git')
+        with open(shim, 'w') as file:
+            file.write(f'#!/bin/sh\necho "$1" >> "$BENCH_GIT_LOG"\nexec "{REAL_GIT}" "$@"\n')
+        os.chmod(shim, 0o755)
+
+        if args.transport == 'git':
+            daemon, proxy, git_base = start_git_daemon(seed_dir)
+        else:
+            git_base = f"file://{seed_dir}"
+
+        for count in (int(value) for value in args.scenarios.split(',') if value.strip()):
+            listing = make_listing(count, seeds, git_base)
+            server = StubGitHub(listing, seeds, git_base)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            archive_dir = os.path.join(work_dir, f"archive-{count}")
+            if os.path.exists(archive_dir):
+                shutil.rmtree(archive_dir)
+            os.makedirs(archive_dir)
+            try:
+                # A cold run into an empty archive, then a resync of the same stars
+                for run in ('cold', 'warm'):
+                    print(f"Running {run} sync of {count} starred repositories...")
+                    result = run_tool(server, proxy, archive_dir, shim_dir, os.path.join(work_dir, f"archive-{count}.log"))
+                    result.update(stars=count, run=run)
+                    results.append(result)
+                    print(f"  finished in {result['wall_time']:.2f}s (exit code {result['exit_code']})")
+                    if result['crash']:
+                        print(f"  the tool crashed: {result['crash']}")
+                    if result['missing_fields']:
+                        print(f"  the stub API does not serve requested fields: {', '.join(result['missing_fields'])}")
+            finally:
+                server.shutdown()
+                server.server_close()
+
+        print()
+        print_results(results)
+        if args.json:
+            with open(args.json, 'w') as file:
+                json.dump(results, file, indent=4)
+        failed = [result for result in results if result['exit_code'] or result['crash'] or result['missing_fields']]
+        if failed:
+            kept = f"see the logs in {work_dir}" if args.keep or args.workdir else "run with --keep to inspect the logs"
+            sys.stderr.write(f"\n{len(failed)} run(s) failed, {kept}\n")
+            sys.exit(1)
+    finally:
+        if proxy is not None:
+            proxy.close()
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+        if args.keep or args.workdir:
+            print(f"\nWork directory kept at {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+try:
+    if __name__ == '__main__':
+        main()
+except KeyboardInterrupt:
+    print('Exiting...')
@@ -1,334 +1,1481 @@
 import os
 #import requests
-import httpx
 import subprocess
 import time
 import re
 import sys
 from datetime import datetime
 import json
+import shutil
+import glob
+import hashlib
+import random
 import argparse
+import contextlib
 import logging
+import threading
+import queue
+import heapq
+import selectors
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 
 # Detecting Python 3 for version-dependent implementations
 if sys.version_info.major < 3:
     raise Exception("Python's major versions earlier than 3 are not supported!")
 
-logging.basicConfig(level=logging.INFO)
+# The HTTP stack is slow to import, so it is only loaded by invocations that
+# talk to GitHub (see load_http_stack)
+httpx = None
+asyncio = None
+HTTP2 = False
+
+def load_http_stack():
+    global httpx, asyncio, HTTP2
+    if httpx is not None:
+        return
+    import asyncio
+    import httpx
+    # HTTP/2 support in httpx is optional and needs the h2 package
+    try:
+        import h2  # noqa: F401
+        HTTP2 = True
+    except ImportError:
+        HTTP2 = False
 
 original_dir = os.getcwd()
 
-parser = argparse.ArgumentParser(prog="git-archv",description="Fetch starred repos from GitHub.")
-parser.add_argument('--token', type=str, help="GitHub token", required=False)
-parser.add_argument('--username', type=str, help="GitHub username", required=False)
-parser.add_argument('--apages', type=int, help="Number of API Pages", required=False)
-parser.add_argument('--depth', type=int, help="Clone depth", required=False)
-parser.add_argument('--errbreak', type=bool, help="Stop processing and break on ERROR", required=False, nargs='?', metavar='NONE')
-parser.add_argument('--errexit', type=bool, help="Stop processing and exit on ERROR", required=False, nargs='?', metavar='NONE')
-parser.add_argument('--verbose', type=bool, help="Verbose output", required=False, nargs='?', metavar='NONE')
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="git-archv",description="Fetch starred repos from GitHub.")
+    parser.add_argument('command', nargs='?', choices=['sync', 'verify'], default='sync', help="'sync' (default) clones and updates repositories, 'verify' checks the integrity of the archive")
+    parser.add_argument('--token', type=str, help="GitHub token, or several comma-separated tokens used in rotation", required=False)
+    parser.add_argument('--username', type=str, help="GitHub username", required=False)
+    parser.add_argument('--users', type=str, help="Comma-separated GitHub users whose starred repositories are synced together", required=False)
+    parser.add_argument('--orgs', type=str, help="Comma-separated organizations whose repositories are synced", required=False)
+    parser.add_argument('--repo-list', type=str, help="File listing repositories to sync, one owner/name per line", required=False)
+    parser.add_argument('--api-url', type=str, help="GitHub API base URL (for GitHub Enterprise or a local stub)", required=False)
+    parser.add_argument('--apages', type=int, help="Number of API Pages (100 repositories each)", required=False)
+    parser.add_argument('--depth', type=int, help="Clone depth for shallow clones", required=False)
+    parser.add_argument('--strategy', choices=['auto', 'full', 'shallow', 'blobless', 'treeless', 'single-branch'], default='shallow', help="Clone strategy; 'auto' picks one from the repository size", required=False)
+    parser.add_argument('--full-below', type=int, default=50, help="With --strategy auto, clone repositories smaller than this many MB in full", required=False)
+    parser.add_argument('--shallow-above', type=int, default=2048, help="With --strategy auto, shallow-clone repositories larger than this many MB (blobless in between)", required=False)
+    parser.add_argument('--errbreak', type=bool, help="Stop processing and break on ERROR", required=False, nargs='?', metavar='NONE')
+    parser.add_argument('--errexit', type=bool, help="Stop processing and exit on ERROR", required=False, nargs='?', metavar='NONE')
+    parser.add_argument('--verbose', type=bool, help="Verbose output", required=False, nargs='?', metavar='NONE')
+    parser.add_argument('--quota', type=float, help="Maximum size of the archive in GB", required=False)
+    parser.add_argument('--quota-policy', choices=['downgrade', 'skip'], default='downgrade', help="Near the quota, clone with cheaper strategies or skip new repositories", required=False)
+    parser.add_argument('--min-free', type=int, default=1024, help="Free disk space in MB that new clones must leave", required=False)
+    parser.add_argument('--max-transfer', type=int, help="Transfer budget of a run in MB, no new clones are started past it", required=False)
+    parser.add_argument('--removed-policy', choices=['keep', 'archive', 'prune'], default='keep', help="What to do with repositories no longer listed: keep them, move them to .unstarred or prune them into the repository cache", required=False)
+    parser.add_argument('--repo-cache-days', type=int, default=180, help="Days to keep pruned and displaced repositories in the repository cache", required=False)
+    parser.add_argument('--mirror', action='store_true', help="Archive repositories as bare mirrors, sharing objects between forks and their parents", required=False)
+    parser.add_argument('--fresh', action='store_true', help="Ignore the checkpoint of an interrupted run and start over", required=False)
+    parser.add_argument('--wiki-ttl', type=int, default=7, help="Days to remember that a repository has no wiki before checking again", required=False)
+    parser.add_argument('--plan', action='store_true', help="Show what a sync would do, from the cached listing and the local state, without network access or git", required=False)
+    parser.add_argument('--incremental', action='store_true', help="Skip repositories not pushed to since their last successful sync", required=False)
+    parser.add_argument('--no-cache', action='store_true', help="Disable the conditional-request cache for GitHub API responses", required=False)
+    parser.add_argument('--cache-max-age', type=int, default=30, help="Evict cached API responses unused for this many days", required=False)
+    parser.add_argument('--cache-max-size', type=int, default=200, help="Maximum size of the API response cache in MB", required=False)
+    parser.add_argument('--metrics', type=str, help="Append run metrics as JSON lines to this file", required=False)
+    parser.add_argument('--prometheus', type=str, help="Write run metrics in Prometheus textfile format to this file", required=False)
+    parser.add_argument('--jobs', type=int, help="Number of repositories to process in parallel (default 1, or one per CPU for verify)", required=False)
+    parser.add_argument('--api-jobs', type=int, default=4, help="Maximum concurrent GitHub API requests, shared by the listing, metadata lookups and all workers", required=False)
+    parser.add_argument('--verify-sample', type=float, default=0.05, help="Fraction of unchanged repositories checked again by verify", required=False)
+    parser.add_argument('--git-jobs', type=int, help="Maximum concurrent git transfers (clone/fetch/pull), defaults to --jobs", required=False)
+    return parser.parse_args(argv)
 
-args = parser.parse_args()
 
-GITHUB_TOKEN = args.token or os.getenv("GITHUB_TOKEN")
-GITHUB_USERNAME = args.username or os.getenv("GITHUB_USERNAME")
+def configure(options):
+    # Settings from the command line and the environment, kept as globals
+    global args, GITHUB_TOKEN, GITHUB_USERNAME, GITHUB_API_URL, GITHUB_GRAPHQL_URL, GITHUB_TOKENS
+    global API_PAGES, API_JOBS, GITHUB_USERS, GITHUB_ORGS, REPO_LIST_FILE, SOURCES
+    global verboseOut, breakOnERR, exitOnERR, incrementalSync, mirrorMode, JOBS, api_slots, git_slots
+    global CLONE_DEPTH, CLONE_STRATEGY, WIKI_PROBE_TTL, FULL_BELOW, SHALLOW_ABOVE
+    global ARCHIVE_QUOTA, QUOTA_POLICY, MIN_FREE_SPACE, TRANSFER_BUDGET, REMOVED_POLICY, REPO_CACHE_MAX_AGE
+    global useCache, CACHE_MAX_AGE, CACHE_MAX_SIZE, METRICS_FILE, PROMETHEUS_FILE, VERIFY_SAMPLE
+    global api_scheduler, repo_output
+    args = options
 
-try:
-    API_PAGES = int(args.apages) or -1
-except:
-     API_PAGES = -1
-NUM_API_PAGES = 0
+    GITHUB_TOKEN = args.token or os.getenv("GITHUB_TOKEN")
+    GITHUB_USERNAME = args.username or os.getenv("GITHUB_USERNAME")
+    GITHUB_API_URL = (args.api_url or os.getenv("GITHUB_API_URL") or 'https://api.github.com').rstrip('/')
+    # GitHub Enterprise serves REST under /api/v3 and GraphQL under /api/graphql
+    GITHUB_GRAPHQL_URL = f"{GITHUB_API_URL[:-3] if GITHUB_API_URL.endswith('/v3') else GITHUB_API_URL}/graphql"
+
+    try:
+        API_PAGES = int(args.apages) or -1
+    except:
+         API_PAGES = -1
+    API_JOBS = max(1, args.api_jobs)
+
+    # Batch mode: the work set is built from several sources (users' stars,
+    # organizations' repositories, repository lists) and deduplicated
+    GITHUB_USERS = list(dict.fromkeys(user.strip() for user in [GITHUB_USERNAME or '', *(args.users or '').split(',')] if user.strip()))
+    GITHUB_ORGS = list(dict.fromkeys(org.strip() for org in (args.orgs or '').split(',') if org.strip()))
+    REPO_LIST_FILE = args.repo_list
+    SOURCES = [f'stars:{user}' for user in GITHUB_USERS] + [f'org:{org}' for org in GITHUB_ORGS]
+    if REPO_LIST_FILE:
+        SOURCES.append(f'list:{REPO_LIST_FILE}')
+
+    if args.command == 'sync' and not SOURCES:
+        raise ValueError("GitHub username (or --users, --orgs or --repo-list) must be provided via CLI args or environment variables")
+    if args.command == 'sync' and not args.plan and not GITHUB_TOKEN:
+        raise ValueError("GitHub token must be provided via CLI args or environment variables")
+
+    verboseOut = args.verbose or  False
+    breakOnERR = args.errbreak or False
+    exitOnERR = args.errexit or False
+    incrementalSync = args.incremental
+    mirrorMode = args.mirror
+
+    # Worker pool sizing: repositories are processed by JOBS workers, while API
+    # requests and git network transfers are capped separately per host
+    JOBS = max(1, args.jobs or 1)
+    api_slots = threading.BoundedSemaphore(API_JOBS)
+    git_slots = threading.BoundedSemaphore(max(1, args.git_jobs or JOBS))
+
+    # The Authorization header is added per request by the rate-limit
+    # scheduler, which rotates between the given tokens
+    GITHUB_TOKENS = [token.strip() for token in (GITHUB_TOKEN or '').split(',') if token.strip()]
+
+    # Set the depth for shallow cloning (use None for full cloning)
+    CLONE_DEPTH = args.depth or  1
 
-if not GITHUB_TOKEN or not GITHUB_USERNAME:
-    raise ValueError("GitHub token and username must be provided via CLI args or environment variables")
+    # Clone strategy and the size thresholds (in KB, like the API's size) used
+    # to pick one per repository with --strategy auto
+    CLONE_STRATEGY = args.strategy
+    FULL_BELOW = args.full_below * 1024
+    SHALLOW_ABOVE = args.shallow_above * 1024
 
-verboseOut = args.verbose or  False
-breakOnERR = args.errbreak or False
-exitOnERR = args.errexit or False
+    # How long a wiki found missing is not looked for again, in seconds
+    WIKI_PROBE_TTL = args.wiki_ttl * 86400
 
-# GitHub API headers for authentication
-GITHUB_TOKEN = GITHUB_TOKEN.strip()
+    # Disk and transfer limits for new clones, in bytes
+    ARCHIVE_QUOTA = int(args.quota * 1024 ** 3) if args.quota else None
+    QUOTA_POLICY = args.quota_policy
+    MIN_FREE_SPACE = args.min_free * 1024 ** 2
+    TRANSFER_BUDGET = args.max_transfer * 1024 ** 2 if args.max_transfer else None
+
+    # Repositories no longer listed, and how long the repository cache
+    # keeps them, in seconds
+    REMOVED_POLICY = args.removed_policy
+    REPO_CACHE_MAX_AGE = args.repo_cache_days * 86400
+
+    # On-disk cache of GitHub API responses (CACHE_DIR), revalidated with
+    # ETag/Last-Modified
+    useCache = not args.no_cache
+    CACHE_MAX_AGE = args.cache_max_age * 86400
+    CACHE_MAX_SIZE = args.cache_max_size * 1024 * 1024
+
+    # Run metrics are optionally streamed as JSON lines (--metrics) and written
+    # as a Prometheus textfile (--prometheus)
+    METRICS_FILE = args.metrics
+    PROMETHEUS_FILE = args.prometheus
+
+    VERIFY_SAMPLE = args.verify_sample
+
+    api_scheduler = RateLimitScheduler(GITHUB_TOKENS)
+    checkpoint['sources'] = SOURCES
+    if JOBS > 1 and args.command == 'sync' and not args.plan:
+        repo_output = RepoOutput(sys.stdout)
+        sys.stdout = repo_output
+        sys.stderr = repo_output.for_stream(sys.stderr)
+
+API_PER_PAGE = 100
+
+# GitHub API headers for every request
 Reqheaders = {
-    'Authorization': f'token {GITHUB_TOKEN}',
     'Accept': 'application/vnd.github.v3+json'
 }
 
-# Set the depth for shallow cloning (use None for full cloning)
-CLONE_DEPTH = args.depth or  1  # Set this to None for full cloning
+# Shared object stores for fork networks in mirror mode, one bare repository
+# per parent whose objects are borrowed by its forks through alternates
+OBJECT_POOLS_DIR = '.objects'
+
+# On-disk cache of GitHub API responses
+CACHE_DIR = 'cache'
+CACHED_HEADERS = ('Link', 'Content-Type', 'ETag', 'Last-Modified')
+
+# Clone state journal: one JSON record per line, appended after every sync.
+# The legacy JSON list is migrated into it on first load.
+CLONED_REPOS_FILE = 'cloned_repos.jsonl'
+LEGACY_CLONED_REPOS_FILE = 'cloned_repos.json'
 
-#CACHE_DIR = 'cache'
-CLONED_REPOS_FILE = 'cloned_repos.json'
+# Checkpoint of the current run, removed once a run finishes: an index of
+# the fetched listing pages (each page is its own file under pages/) and a
+# journal of completed and in-flight repositories
+CHECKPOINT_DIR = '.checkpoint'
+CHECKPOINT_FILE = 'checkpoint.json'
+CHECKPOINT_JOURNAL = 'progress.jsonl'
 
-counting_objects_re = re.compile(r'Counting objects:\s*(\d+)')
+counting_objects_re = re.compile(r'Counting objects:\s*(?:\d+%\s*\((\d+)/\d+\)|(\d+))')
 compressing_objects_re = re.compile(r'Compressing objects:\s*(\d+)%\s*\((\d+)/(\d+)\)')
 deltas_re = re.compile(r'Total\s+(\d+)\s*\(delta\s+(\d+)\),\s*reused\s+(\d+)\s*\(delta\s+(\d+)\)\,\s*pack-reused\s+(\d+)')
-recv_objects_re = re.compile(r'Receiving objects\:\s+(\d+)\%\s+\((\d+)\/(\d+)\),\s+([\d.]+)\s+(\w+)\s+\|\s+([\d.]+)\s+(\w+)\/s')
-resv_deltas_re = re.compile(r'Resolving deltas\:\s+(\d+)\%\s+\((\d+)\/(\d+)\)\,\s+done')
+recv_objects_re = re.compile(r'Receiving objects\:\s+(\d+)\%\s+\((\d+)\/(\d+)\)(?:,\s+([\d.]+)\s+(\w+)\s+\|\s+([\d.]+)\s+(\w+)\/s)?')
+resv_deltas_re = re.compile(r'Resolving deltas\:\s+(\d+)\%\s+\((\d+)\/(\d+)\)')
+
+# Progress from git is rendered at most every PROGRESS_INTERVAL seconds
+PROGRESS_INTERVAL = 0.5
+SIZE_UNITS = {'bytes': 1, 'byte': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3, 'TiB': 1024 ** 4}
+
+# Run metrics: per-phase timings and counters
+metrics_lock = threading.Lock()
+phase_metrics = {}  # phase -> [count, total seconds]
+counter_metrics = {}
+gauge_metrics = set()  # names in counter_metrics set with set_metric
+metrics_journal = None
 
-"""
-def load_cached_page(page_num):
-    cache_file = os.path.join(CACHE_DIR, f'github_cache_page_{page_num}.json')
+def record_metric(event, **fields):
+    global metrics_journal
+    if not METRICS_FILE:
+        return
+    line = json.dumps({'ts': round(time.time(), 3), 'event': event, **fields})
+    with metrics_lock:
+        if metrics_journal is None:
+            metrics_journal = open(METRICS_FILE, 'a', encoding='utf-8')
+        metrics_journal.write(line + '\n')
+        metrics_journal.flush()
+
+def count_metric(name, value=1):
+    with metrics_lock:
+        counter_metrics[name] = counter_metrics.get(name, 0) + value
+
+def set_metric(name, value):
+    with metrics_lock:
+        counter_metrics[name] = value
+        gauge_metrics.add(name)
+
+@contextlib.contextmanager
+def timed_phase(phase, repo=None):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        seconds = time.monotonic() - started
+        with metrics_lock:
+            totals = phase_metrics.setdefault(phase, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+        record_metric('phase', phase=phase, repo=repo, seconds=round(seconds, 3))
+
+def print_metrics_summary():
+    print(f"\n{'Phase':<12}{'Count':>8}{'Total s':>12}{'Avg s':>10}")
+    for phase, (count, seconds) in sorted(phase_metrics.items(), key=lambda item: -item[1][1]):
+        print(f"{phase:<12}{count:>8}{seconds:>12.1f}{seconds / count:>10.2f}")
+    for name, value in sorted(counter_metrics.items()):
+        print(f"  - {name}: {value}")
+
+def write_prometheus_metrics():
+    lines = [
+        '# HELP git_archv_phase_seconds_total Time spent per sync phase.',
+        '# TYPE git_archv_phase_seconds_total counter',
+    ]
+    lines += [f'git_archv_phase_seconds_total{{phase="{phase}"}} {seconds:.3f}' for phase, (_, seconds) in sorted(phase_metrics.items())]
+    lines += [
+        '# HELP git_archv_phase_runs_total Number of times each sync phase ran.',
+        '# TYPE git_archv_phase_runs_total counter',
+    ]
+    lines += [f'git_archv_phase_runs_total{{phase="{phase}"}} {count}' for phase, (count, _) in sorted(phase_metrics.items())]
+    # Counts only grow during a run; values set as a whole are gauges
+    for name, value in sorted(counter_metrics.items()):
+        if name in gauge_metrics:
+            lines.append(f'# TYPE git_archv_{name} gauge')
+            lines.append(f'git_archv_{name} {value}')
+        else:
+            lines.append(f'# TYPE git_archv_{name}_total counter')
+            lines.append(f'git_archv_{name}_total {value}')
+    lines.append('# TYPE git_archv_last_run_timestamp_seconds gauge')
+    lines.append(f'git_archv_last_run_timestamp_seconds {int(time.time())}')
+    # Textfile collectors may read at any time, so replace the file atomically
+    with open(f"{PROMETHEUS_FILE}.tmp", 'w', encoding='utf-8') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(f"{PROMETHEUS_FILE}.tmp", PROMETHEUS_FILE)
+
+def get_cache_file(url):
+    return os.path.join(original_dir, CACHE_DIR, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+def load_cached_response(url):
+    cache_file = get_cache_file(url)
     if os.path.exists(cache_file):
-        with open(cache_file, 'r') as file:
-            return json.load(file)
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, json.JSONDecodeError):
+            return None
     return None
 
-def save_page_to_cache(page_num, data):
-    if not os.path.exists(CACHE_DIR):
-        os.makedirs(CACHE_DIR)
-    cache_file = os.path.join(CACHE_DIR, f'github_cache_page_{page_num}.json')
-    with open(cache_file, 'w') as file:
-        json.dump(data, file, indent=4)
-"""
-
-def load_cloned_repos():
-    if not os.path.exists(CLONED_REPOS_FILE):
-        with open(f"{original_dir}/{CLONED_REPOS_FILE}", 'w') as file:
-            json.dump([], file, indent=4)
-        return []
+def save_response_to_cache(url, response):
+    headers = {name: response.headers[name] for name in CACHED_HEADERS if name in response.headers}
+    if 'ETag' not in headers and 'Last-Modified' not in headers:
+        return
+    cache_file = get_cache_file(url)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(f"{cache_file}.{threading.get_ident()}.tmp", 'w', encoding='utf-8') as file:
+        json.dump({'url': url, 'headers': headers, 'body': response.text}, file)
+    os.replace(f"{cache_file}.{threading.get_ident()}.tmp", cache_file)
+
+def evict_cache():
+    # Drop entries unused for CACHE_MAX_AGE, then the least recently used
+    # ones until the cache fits in CACHE_MAX_SIZE
+    cache_dir = os.path.join(original_dir, CACHE_DIR)
+    if not os.path.isdir(cache_dir):
+        return
+    now = time.time()
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if not entry.is_file():
+            continue
+        stat = entry.stat()
+        if now - stat.st_mtime > CACHE_MAX_AGE:
+            os.remove(entry.path)
+        else:
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= CACHE_MAX_SIZE:
+            break
+        os.remove(path)
+        total_size -= size
+
+# Every API request goes through one scheduler. Each token has a token
+# bucket per API resource (REST and GraphQL are limited separately) that
+# refills at the rate the rate-limit headers allow: the remaining budget
+# spread evenly over what is left of the reset window. Requests go to the
+# token that can serve them soonest, so several tokens add up.
+RATE_LIMIT_BURST = 50
+API_RETRIES = 5
+API_BACKOFF_BASE = 1.0
+API_BACKOFF_MAX = 120.0
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    __slots__ = ('token', 'tokens', 'rate', 'updated', 'remaining', 'reset_at', 'blocked_until')
+
+    def __init__(self, token):
+        self.token = token
+        self.tokens = float(RATE_LIMIT_BURST)
+        self.rate = None  # unknown until the first response: no pacing
+        self.updated = time.time()
+        self.remaining = None
+        self.reset_at = 0.0
+        self.blocked_until = 0.0
+
+    def refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(RATE_LIMIT_BURST, self.tokens + (now - self.updated) * self.rate)
+        else:
+            self.tokens = max(self.tokens, 1.0)
+        self.updated = now
+
+    def ready_at(self, now):
+        ready = max(now, self.blocked_until)
+        if self.remaining == 0 and self.reset_at > now:
+            ready = max(ready, self.reset_at)
+        if self.tokens < 1 and self.rate:
+            ready = max(ready, now + (1 - self.tokens) / self.rate)
+        return ready
+
+class RateLimitScheduler:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_buckets(self, resource):
+        if resource not in self.buckets:
+            self.buckets[resource] = [TokenBucket(token) for token in self.tokens]
+        return self.buckets[resource]
+
+    def reserve(self, resource='core'):
+        # Take a slot on the token that frees up first; returns the bucket
+        # to send the request with and how long to wait before sending it
+        with self.lock:
+            now = time.time()
+            buckets = self.get_buckets(resource)
+            for bucket in buckets:
+                bucket.refill(now)
+            bucket = min(buckets, key=lambda bucket: (bucket.ready_at(now), -bucket.tokens))
+            start = bucket.ready_at(now)
+            # The slot is taken now; a bucket in debt makes the next caller
+            # wait its turn behind this one
+            bucket.refill(start)
+            bucket.tokens -= 1
+            if bucket.remaining:
+                bucket.remaining -= 1
+            return bucket, start - now
+
+    def update(self, bucket, response):
+        headers = response.headers
+        now = time.time()
+        with self.lock:
+            remaining = headers.get('X-RateLimit-Remaining')
+            reset_time = headers.get('X-RateLimit-Reset')
+            if remaining is not None and reset_time is not None:
+                bucket.remaining = int(remaining)
+                bucket.reset_at = float(reset_time)
+                window = max(1.0, bucket.reset_at - now)
+                bucket.rate = bucket.remaining / window
+                # Never allow a burst larger than what is left
+                bucket.tokens = min(bucket.tokens, float(bucket.remaining))
+            retry_after = get_retry_after(response)
+            if retry_after is not None:
+                bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+            elif bucket.remaining == 0 and is_rate_limited(response):
+                bucket.blocked_until = max(bucket.blocked_until, bucket.reset_at)
+            return max(0.0, bucket.blocked_until - now)
+
+    def remaining(self, resource='core'):
+        with self.lock:
+            known = [bucket.remaining for bucket in self.get_buckets(resource) if bucket.remaining is not None]
+            return sum(known) if known else None
+
+api_scheduler = None
+
+def get_retry_after(response):
+    retry_after = response.headers.get('Retry-After')
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return None
+
+def is_rate_limited(response):
+    # 403 is also used for primary and secondary rate limits
+    if response.status_code == 429:
+        return True
+    if response.status_code != 403:
+        return False
+    return (response.headers.get('X-RateLimit-Remaining') == '0'
+            or 'Retry-After' in response.headers
+            or 'rate limit' in response.text.lower())
+
+def should_retry(response):
+    return response.status_code in RETRY_STATUS_CODES or is_rate_limited(response)
+
+def get_backoff_delay(attempt):
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt))
+
+def record_api_response(bucket, response):
+    count_metric('api_requests')
+    if response.status_code == 304:
+        count_metric('api_not_modified')
+    blocked = api_scheduler.update(bucket, response)
+    remaining = api_scheduler.remaining()
+    if remaining is not None:
+        set_metric('rate_limit_remaining', remaining)
+    if blocked > 60:
+        print(f"Rate limit hit! Waiting for {int(blocked)} seconds (until {datetime.fromtimestamp(time.time() + blocked)})...")
+
+def get_retry_delay(attempt, response=None):
+    count_metric('api_retries')
+    delay = get_backoff_delay(attempt)
+    if response is not None:
+        delay = max(delay, get_retry_after(response) or 0.0)
+    return delay
+
+def get_request_headers(bucket, headers):
+    request_headers = dict(headers)
+    request_headers['Authorization'] = f'token {bucket.token}'
+    return request_headers
+
+def wait_for_slot(delay):
+    if delay > 0:
+        count_metric('rate_limit_waits')
+        count_metric('rate_limit_wait_seconds', round(delay, 3))
+    return delay
+
+def send_api_request(method, url, headers, resource='core', **kwargs):
+    # Send a request through the scheduler, retrying rate limits, server
+    # errors and connection failures with backoff. The last response is
+    # returned (or the last error raised) once the retries run out.
+    for attempt in range(API_RETRIES + 1):
+        bucket, delay = api_scheduler.reserve(resource)
+        time.sleep(wait_for_slot(delay))
+        try:
+            with api_slots:
+                response = get_http_client().request(method, url, headers=get_request_headers(bucket, headers), **kwargs)
+        except httpx.RequestError as e:
+            if attempt == API_RETRIES:
+                raise
+            sys.stderr.write(f"API request failed ({e}), retrying...\n")
+            time.sleep(get_retry_delay(attempt))
+            continue
+        record_api_response(bucket, response)
+        if not should_retry(response) or attempt == API_RETRIES:
+            return response
+        time.sleep(get_retry_delay(attempt, response))
+
+async def acquire_api_slot():
+    # api_slots is shared with the threads sending synchronous requests.
+    # Polling keeps the event loop free and leaves no slot taken when the
+    # task is cancelled while waiting.
+    while not api_slots.acquire(blocking=False):
+        await asyncio.sleep(0.05)
+
+async def send_api_request_async(client, semaphore, method, url, headers, resource='core', **kwargs):
+    for attempt in range(API_RETRIES + 1):
+        bucket, delay = api_scheduler.reserve(resource)
+        await asyncio.sleep(wait_for_slot(delay))
+        try:
+            async with semaphore:
+                await acquire_api_slot()
+                try:
+                    response = await client.request(method, url, headers=get_request_headers(bucket, headers), **kwargs)
+                finally:
+                    api_slots.release()
+        except httpx.RequestError as e:
+            if attempt == API_RETRIES:
+                raise
+            sys.stderr.write(f"API request failed ({e}), retrying...\n")
+            await asyncio.sleep(get_retry_delay(attempt))
+            continue
+        record_api_response(bucket, response)
+        if not should_retry(response) or attempt == API_RETRIES:
+            return response
+        await asyncio.sleep(get_retry_delay(attempt, response))
+
+def get_conditional_headers(url, headers):
+    cached = load_cached_response(url) if useCache else None
+    request_headers = dict(headers)
+    if cached:
+        if 'ETag' in cached['headers']:
+            request_headers['If-None-Match'] = cached['headers']['ETag']
+        if 'Last-Modified' in cached['headers']:
+            request_headers['If-Modified-Since'] = cached['headers']['Last-Modified']
+    return cached, request_headers
+
+def resolve_cached_response(url, cached, response):
+    if response.status_code == 304 and cached:
+        os.utime(get_cache_file(url))
+        merged_headers = dict(cached['headers'])
+        merged_headers.update((name, value) for name, value in response.headers.items() if name.lower().startswith('x-ratelimit'))
+        return httpx.Response(200, headers=merged_headers, text=cached['body'], request=response.request)
+    if response.status_code == 200 and useCache:
+        save_response_to_cache(url, response)
+    return response
+
+http_client = None
+http_client_lock = threading.Lock()
+
+def get_http_client():
+    # One pooled keep-alive client shared by all worker threads
+    global http_client
+    with http_client_lock:
+        if http_client is None:
+            http_client = httpx.Client(http2=HTTP2, timeout=10, limits=httpx.Limits(max_connections=API_JOBS))
+        return http_client
+
+def api_post(url, headers, payload):
+    return send_api_request('POST', url, headers, resource='graphql', json=payload)
+
+async def api_get_async(client, semaphore, url, headers):
+    # GET a GitHub API URL, revalidating any cached copy with a conditional
+    # request. 304 responses do not count against the rate limit; they are
+    # answered from the cache with the fresh rate-limit headers.
+    cached, request_headers = get_conditional_headers(url, headers)
+    response = await send_api_request_async(client, semaphore, 'GET', url, request_headers)
+    return resolve_cached_response(url, cached, response)
+
+class RepoOutput:
+    """stdout wrapper used in parallel mode: output written by a worker is
+    buffered per thread and printed as one block once its repository is done,
+    so logs of concurrent clones do not interleave. Wrappers of other streams
+    made with for_stream() share the buffer, keeping stdout and stderr of a
+    repository in the order they were written."""
+
+    def __init__(self, stream, shared=None):
+        self.stream = stream
+        self.local = shared.local if shared else threading.local()
+        self.lock = shared.lock if shared else threading.Lock()
+
+    def for_stream(self, stream):
+        return RepoOutput(stream, self)
+
+    def begin(self):
+        self.local.buffer = []
+
+    def end(self):
+        buffer = getattr(self.local, 'buffer', None)
+        self.local.buffer = None
+        if buffer:
+            with self.lock:
+                for stream, text in buffer:
+                    stream.write(text)
+                for stream in {stream for stream, _ in buffer}:
+                    stream.flush()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is not None:
+            buffer.append((self.stream, text))
+            return len(text)
+        with self.lock:
+            return self.stream.write(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+repo_output = None  # set up by configure() in parallel mode
+
+state_lock = threading.Lock()
+
+cloned_repos = None  # folder name -> metadata, loaded once per run
+cloned_repo_ids = {}  # GitHub repository ID -> folder name
+state_journal = None
+
+def write_state_journal(repos):
+    # Rewrite the journal with one record per repository, atomically
+    journal_path = f"{original_dir}/{CLONED_REPOS_FILE}"
+    with open(f"{journal_path}.tmp", 'w', encoding='utf-8') as file:
+        for name, metadata in repos.items():
+            file.write(json.dumps({'name': name, **metadata}) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f"{journal_path}.tmp", journal_path)
+
+def load_cloned_repos(read_only=False):
+    # With read_only (dry runs) the journal is neither compacted nor
+    # migrated; the state is only read
+    global cloned_repos
+    with state_lock:
+        if cloned_repos is not None:
+            return cloned_repos
+
+        repos = {}
+        journal_path = f"{original_dir}/{CLONED_REPOS_FILE}"
+        legacy_path = f"{original_dir}/{LEGACY_CLONED_REPOS_FILE}"
+        if os.path.exists(journal_path):
+            records = 0
+            damaged = False
+            with open(journal_path, 'r', encoding='utf-8') as file:
+                for line_no, line in enumerate(file, start=1):
+                    if not line.endswith('\n'):
+                        # Torn write from an interrupted run
+                        damaged = True
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                        name = record.pop('name')
+                    except (json.JSONDecodeError, KeyError, AttributeError):
+                        print(f"Warning: skipping damaged entry on line {line_no} of {CLONED_REPOS_FILE}")
+                        damaged = True
+                        continue
+                    records += 1
+                    if record.pop('deleted', False):
+                        repos.pop(name, None)
+                    else:
+                        repos.setdefault(name, {}).update(record)
+            # Compact when damaged or when superseded records dominate
+            if not read_only and (damaged or records > 2 * len(repos) + 100):
+                write_state_journal(repos)
+        elif os.path.exists(legacy_path):
+            try:
+                with open(legacy_path, 'r') as file:
+                    legacy_repos = json.load(file)
+            except json.JSONDecodeError:
+                print(f"Warning: {LEGACY_CLONED_REPOS_FILE} is corrupted, existing clones will be detected from disk.")
+                legacy_repos = []
+            for name in legacy_repos:
+                repos[name] = {'status': 'cloned'}
+            if not read_only:
+                print(f"Migrating {len(repos)} entries from {LEGACY_CLONED_REPOS_FILE} to {CLONED_REPOS_FILE}...")
+                write_state_journal(repos)
+
+        cloned_repos = repos
+        cloned_repo_ids.update((metadata['id'], name) for name, metadata in repos.items() if metadata.get('id') is not None)
+        return cloned_repos
+
+def get_cloned_repo(repo_name):
+    return load_cloned_repos().get(repo_name)
+
+def append_state_record(record):
+    # Called with state_lock held
+    global state_journal
+    if state_journal is None:
+        state_journal = open(f"{original_dir}/{CLONED_REPOS_FILE}", 'a', encoding='utf-8')
+    state_journal.write(json.dumps(record) + '\n')
+    state_journal.flush()
+    os.fsync(state_journal.fileno())
+
+def update_cloned_repo(repo_name, **metadata):
+    # Merge fields into a repository's state without marking it synced
+    repos = load_cloned_repos()
+    with state_lock:
+        record = repos.setdefault(repo_name, {})
+        if metadata.get('id') is not None:
+            # A name now taken by another repository no longer maps its old ID
+            previous_id = record.get('id')
+            if previous_id not in (None, metadata['id']) and cloned_repo_ids.get(previous_id) == repo_name:
+                del cloned_repo_ids[previous_id]
+            cloned_repo_ids[metadata['id']] = repo_name
+        record.update(metadata)
+        append_state_record({'name': repo_name, **metadata})
+
+def save_cloned_repo(repo_name, **metadata):
+    metadata['synced_at'] = datetime.now().isoformat(timespec='seconds')
+    update_cloned_repo(repo_name, **metadata)
+
+def forget_cloned_repo(repo_name):
+    # Drop a repository from the state with a tombstone record
+    repos = load_cloned_repos()
+    with state_lock:
+        metadata = repos.pop(repo_name, None)
+        if metadata and cloned_repo_ids.get(metadata.get('id')) == repo_name:
+            del cloned_repo_ids[metadata['id']]
+        append_state_record({'name': repo_name, 'deleted': True})
+
+def rename_cloned_repo(old_name, new_name):
+    # Carry a renamed or transferred repository's state over to its new name
+    metadata = dict(get_cloned_repo(old_name) or {})
+    forget_cloned_repo(old_name)
+    if metadata:
+        update_cloned_repo(new_name, **metadata)
+
+def find_cloned_repo_by_id(repo_id):
+    load_cloned_repos()
+    with state_lock:
+        return cloned_repo_ids.get(repo_id)
+
+def is_other_repo(metadata, repo):
+    # Whether a state record under a repository's folder name belongs to a
+    # different GitHub repository: the name was freed by a rename or
+    # transfer and taken by a new repository
+    return bool(metadata) and metadata.get('id') is not None and repo.id is not None and metadata['id'] != repo.id
+
+def is_repo_unchanged(repo_name, repo, repo_path):
+    # A repository is unchanged when its last push (or update, for listings
+    # without pushed_at) matches the value recorded at its last good sync
+    metadata = get_cloned_repo(repo_name)
+    if not metadata or metadata.get('status') == 'failed' or metadata.get('broken') or not is_git_repo(repo_path):
+        return False
+    if is_other_repo(metadata, repo):
+        return False
+    if repo.pushed_at:
+        return metadata.get('pushed_at') == repo.pushed_at
+    return repo.updated_at is not None and metadata.get('updated_at') == repo.updated_at
+
+checkpoint = {'sources': [], 'listings': {}, 'completed': set(), 'in_flight': {}}
+checkpoint_lock = threading.Lock()
+checkpoint_journal = None
+
+def get_checkpoint_path(name):
+    return f"{original_dir}/{CHECKPOINT_DIR}/{name}"
+
+def get_page_file(source, page):
+    return f"pages/{hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]}-{page}.json"
+
+def load_checkpoint():
+    if args.fresh or not os.path.exists(get_checkpoint_path(CHECKPOINT_FILE)):
+        remove_checkpoint()
+        return False
     try:
-        with open(f"{original_dir}/{CLONED_REPOS_FILE}", 'r') as file:
-            return json.load(file)
-    except json.JSONDecodeError:
-        print(f"Error: {CLONED_REPOS_FILE} is corrupted. Creating a new file.")
-        with open(f"{original_dir}/{CLONED_REPOS_FILE}", 'w') as file:
-            json.dump([], file, indent=4)
-        return []
-        
-def save_cloned_repo(repo_name):
-    cloned_repos = load_cloned_repos()
-    cloned_repos.append(repo_name)
-    with open(f"{original_dir}/{CLONED_REPOS_FILE}", 'w') as file:
-        json.dump(cloned_repos, file, indent=4)
-
-def is_repo_cloned(repo_name):
-    cloned_repos = load_cloned_repos()
-    return repo_name in cloned_repos
-
-def get_branch_name():
-    current_branch = subprocess.check_output(['git', 'branch'], text=True)
-    current_branch_name = next(line for line in current_branch.splitlines() if line.startswith('* ')).strip()[2:]
-    return current_branch_name
-
-def get_remote_repo():
-    return subprocess.check_output(['git', 'remote'], text=True).strip()
-
-def attempt_fix_repo():
-    __branchN = get_branch_name()
-    __remoteN = get_remote_repo()
-    proc_rcode = subprocess.call(['git','reset','--hard',__branchN])
-    if proc_rcode != 0:
-        sys.stderr.write(f"Unexpected error occurred while attempting to fix Repository\n")
+        with open(get_checkpoint_path(CHECKPOINT_FILE), 'r', encoding='utf-8') as file:
+            saved = json.load(file)
+    except (OSError, json.JSONDecodeError):
+        print(f"Warning: the checkpoint in {CHECKPOINT_DIR} is unreadable, starting a new run.")
+        remove_checkpoint()
+        return False
+    if saved.get('sources') != SOURCES:
+        remove_checkpoint()
+        return False
+    for source, listing in saved.get('listings', {}).items():
+        checkpoint['listings'][source] = {
+            'last_page': listing.get('last_page'),
+            'pages': {page for page in listing.get('pages', []) if os.path.exists(get_checkpoint_path(get_page_file(source, page)))},
+        }
+    # Replay the progress journal; a torn last line is ignored
+    try:
+        with open(get_checkpoint_path(CHECKPOINT_JOURNAL), 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if 'completed' in record:
+                    checkpoint['completed'].add(record['completed'])
+                elif 'in_flight' in record:
+                    checkpoint['in_flight'][record['in_flight']] = record['repo']
+                elif 'cleared' in record:
+                    checkpoint['in_flight'].pop(record['cleared'], None)
+    except FileNotFoundError:
+        pass
+    return True
+
+def save_checkpoint():
+    # Only the small index of listing pages is rewritten (atomically); the
+    # pages themselves are written once each by save_listing_page
+    with checkpoint_lock:
+        data = json.dumps({
+            'sources': checkpoint['sources'],
+            'listings': {source: {'last_page': listing['last_page'], 'pages': sorted(listing['pages'])}
+                         for source, listing in checkpoint['listings'].items()},
+        })
+        checkpoint_path = get_checkpoint_path(CHECKPOINT_FILE)
+        os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+        with open(f"{checkpoint_path}.tmp", 'w', encoding='utf-8') as file:
+            file.write(data)
+        os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+
+def save_listing_page(source, page, repos):
+    page_path = get_checkpoint_path(get_page_file(source, page))
+    os.makedirs(os.path.dirname(page_path), exist_ok=True)
+    with open(f"{page_path}.tmp", 'w', encoding='utf-8') as file:
+        json.dump([repo.to_dict() for repo in repos], file)
+    os.replace(f"{page_path}.tmp", page_path)
+    listing = get_listing_checkpoint(source)
+    with checkpoint_lock:
+        listing['pages'].add(page)
+    save_checkpoint()
+
+def load_listing_page(source, page):
+    with open(get_checkpoint_path(get_page_file(source, page)), 'r', encoding='utf-8') as file:
+        return [StarredRepo(**record) for record in json.load(file)]
+
+def get_listing_checkpoint(source):
+    # Last page and page numbers saved for one source
+    with checkpoint_lock:
+        return checkpoint['listings'].setdefault(source, {'last_page': None, 'pages': set()})
+
+def append_checkpoint_record(record):
+    # Called with checkpoint_lock held. The journal only has to survive the
+    # process dying, so it is flushed but not synced.
+    global checkpoint_journal
+    if checkpoint_journal is None:
+        os.makedirs(get_checkpoint_path(''), exist_ok=True)
+        checkpoint_journal = open(get_checkpoint_path(CHECKPOINT_JOURNAL), 'a', encoding='utf-8')
+    checkpoint_journal.write(json.dumps(record) + '\n')
+    checkpoint_journal.flush()
+
+def remove_checkpoint():
+    global checkpoint_journal
+    with checkpoint_lock:
+        if checkpoint_journal is not None:
+            checkpoint_journal.close()
+            checkpoint_journal = None
+    if os.path.isdir(get_checkpoint_path('')):
+        shutil.rmtree(get_checkpoint_path(''), ignore_errors=True)
+
+def mark_in_flight(path, repo_name):
+    with checkpoint_lock:
+        checkpoint['in_flight'][path] = repo_name
+        append_checkpoint_record({'in_flight': path, 'repo': repo_name})
+
+def clear_in_flight(path):
+    with checkpoint_lock:
+        if checkpoint['in_flight'].pop(path, None) is not None:
+            append_checkpoint_record({'cleared': path})
+
+def mark_completed(repo_name):
+    with checkpoint_lock:
+        checkpoint['completed'].add(repo_name)
+        append_checkpoint_record({'completed': repo_name})
+
+def discard_partial_clones():
+    # Clones that were running when the previous run died are incomplete
+    for path, repo_name in list(checkpoint['in_flight'].items()):
+        if os.path.exists(path) and os.path.abspath(path).startswith(original_dir + os.sep):
+            print(f"Discarding interrupted clone of {repo_name} at {path}")
+            shutil.rmtree(path, ignore_errors=True)
+        clear_in_flight(path)
+
+def get_head_commit(repo_path):
+    proc = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_path, capture_output=True, text=True)
+    return proc.stdout.strip() if proc.returncode == 0 else None
+
+def to_bytes(value, unit):
+    return int(float(value) * SIZE_UNITS.get(unit, 1))
+
+def parse_git_progress(line, stats):
+    # Only the regex matching the phase named in the line is tried
+    if 'Receiving objects' in line:
+        match = recv_objects_re.search(line)
+        if match:
+            stats['received_objects'] = int(match.group(2))
+            stats['total_objects'] = int(match.group(3))
+            if match.group(4):
+                stats['received_bytes'] = to_bytes(match.group(4), match.group(5))
+                stats['speed'] = to_bytes(match.group(6), match.group(7))
+            return True
+    elif 'Resolving deltas' in line:
+        match = resv_deltas_re.search(line)
+        if match:
+            stats['resolved_deltas'] = int(match.group(2))
+            stats['total_deltas'] = int(match.group(3))
+            return True
+    elif 'Counting objects' in line:
+        match = counting_objects_re.search(line)
+        if match:
+            stats['counted_objects'] = int(match.group(1) or match.group(2))
+            return True
+    elif 'Compressing objects' in line:
+        match = compressing_objects_re.search(line)
+        if match:
+            stats['compressed_objects'] = int(match.group(2))
+            return True
+    elif 'pack-reused' in line:
+        match = deltas_re.search(line)
+        if match:
+            stats['total_objects'] = int(match.group(1))
+            stats['total_deltas'] = int(match.group(2))
+            stats['reused_objects'] = int(match.group(3))
+            stats['reused_deltas'] = int(match.group(4))
+            stats['pack_reused'] = int(match.group(5))
+            return True
+    return False
+
+def format_git_progress(stats):
+    line = f"objects {stats.get('received_objects', 0)}/{stats.get('total_objects', 0)}"
+    line += f", {stats.get('received_bytes', 0) / SIZE_UNITS['MiB']:.2f} MiB"
+    line += f" | {stats.get('speed', 0) / SIZE_UNITS['MiB']:.2f} MiB/s"
+    line += f", deltas {stats.get('resolved_deltas', 0)}/{stats.get('total_deltas', 0)}"
+    return line
+
+# Per-thread list collecting the transfer stats of the repository being synced
+transfer_stats = threading.local()
+
+def run_git(command, cwd, transfer=True):
+    # Run a git command, reading its stderr incrementally so that progress
+    # written with '\r' is parsed as it arrives. Returns the exit code, the
+    # transfer stats and the non-progress output lines.
+    stats = {}
+    messages = []
+    show_progress = transfer and repo_output is None
+    if transfer:
+        git_slots.acquire()
+    try:
+        started = time.monotonic()
+        process = subprocess.Popen(command, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        selector = selectors.DefaultSelector()
+        selector.register(process.stderr, selectors.EVENT_READ)
+        pending = b''
+        last_line = None
+        last_render = 0.0
+        changed = False
+        while True:
+            events = selector.select(timeout=PROGRESS_INTERVAL)
+            if events:
+                chunk = os.read(process.stderr.fileno(), 65536)
+                if not chunk:
+                    break
+                segments = re.split(rb'[\r\n]', pending + chunk)
+                pending = segments.pop()
+                for segment in segments:
+                    line = segment.decode('utf-8', errors='replace').strip()
+                    if not line or line == last_line:
+                        continue
+                    last_line = line
+                    if parse_git_progress(line, stats):
+                        changed = True
+                    elif not line.startswith(('remote: Enumerating', 'remote: Total')):
+                        messages.append(line)
+            # Fetches with nothing to transfer still report counting and
+            # totals; only a transfer in progress is rendered
+            if show_progress and changed and 'received_objects' in stats and time.monotonic() - last_render >= PROGRESS_INTERVAL:
+                sys.stdout.write(f"\r{format_git_progress(stats)}")
+                sys.stdout.flush()
+                last_render = time.monotonic()
+                changed = False
+        if pending.strip():
+            line = pending.decode('utf-8', errors='replace').strip()
+            if not parse_git_progress(line, stats):
+                messages.append(line)
+        selector.close()
+        process.stderr.close()
+        return_code = process.wait()
+        stats['duration'] = time.monotonic() - started
+    finally:
+        if transfer:
+            git_slots.release()
+
+    if show_progress and last_render:
+        sys.stdout.write(f"\r{format_git_progress(stats)}\n")
+    if transfer and hasattr(transfer_stats, 'current'):
+        transfer_stats.current.append(stats)
+    return return_code, stats, messages
+
+def choose_clone_strategy(repo_size, recorded_strategy=None):
+    # Existing clones keep the strategy they were created with, so their
+    # fetches stay consistent with how the history was first obtained
+    if recorded_strategy:
+        return recorded_strategy
+    if CLONE_STRATEGY != 'auto':
+        return CLONE_STRATEGY
+    if repo_size is None or repo_size < FULL_BELOW:
+        return 'full'
+    if repo_size > SHALLOW_ABOVE:
+        return 'shallow'
+    return 'blobless'
+
+def get_clone_args(strategy):
+    if strategy == 'shallow':
+        return ['--depth', str(CLONE_DEPTH)]
+    if strategy == 'blobless':
+        return ['--filter=blob:none']
+    if strategy == 'treeless':
+        return ['--filter=tree:0']
+    if strategy == 'single-branch':
+        return ['--single-branch']
+    return []
+
+def get_fetch_args(strategy):
+    # Partial and single-branch clones keep their filter and refspec in the
+    # repository config; shallow clones must be told to stay shallow
+    if strategy == 'shallow':
+        return ['--depth', str(CLONE_DEPTH)]
+    return []
+
+def get_checked_out_branch(repo_path):
+    # Branch, upstream remote/ref and commit of HEAD from a single
+    # for-each-ref; None when git cannot read the repository's refs
+    proc = subprocess.run(
+        ['git', 'for-each-ref', '--format=%(HEAD)%00%(refname:short)%00%(upstream:remotename)%00%(upstream:short)%00%(objectname)', 'refs/heads'],
+        cwd=repo_path, capture_output=True, text=True)
+    if proc.returncode != 0:
+        return None
+    for line in proc.stdout.splitlines():
+        head, branch, remote, upstream, commit = line.split('\0')
+        if head == '*':
+            return branch, remote or None, upstream or None, commit
+    return None, None, None, None
+
+def submodules_changed(repo_path, old_commit):
+    # Whether .gitmodules or any submodule commit (a gitlink, mode 160000)
+    # changed between old_commit and HEAD
+    if not old_commit:
+        return True
+    proc = subprocess.run(['git', 'diff', '--raw', '--no-abbrev', old_commit, 'HEAD'], cwd=repo_path, capture_output=True, text=True)
+    if proc.returncode != 0:
+        return True
+    for line in proc.stdout.splitlines():
+        modes, _, path = line.partition('\t')
+        if path == '.gitmodules' or '160000' in modes.lstrip(':').split()[:2]:
+            return True
+    return False
+
+def submodules_out_of_date(repo_path):
+    # Whether a submodule is not initialized or not at the commit recorded
+    # by HEAD, as left behind by an earlier update that failed
+    proc = subprocess.run(['git', 'submodule', 'status', '--recursive'], cwd=repo_path, capture_output=True, text=True)
+    if proc.returncode != 0:
+        return True
+    return any(line[:1] in ('-', '+', 'U') for line in proc.stdout.splitlines())
+
+def attempt_update_repo(repo_path, strategy='full', default_branch=None):
+    # Update with one network operation: fetch with prune and tags, then
+    # move the checked out branch to its upstream. Submodules are only
+    # touched when .gitmodules changed or they were never initialized.
+    checked_out = get_checked_out_branch(repo_path)
+    if checked_out is None:
+        sys.stderr.write(f"Error: Cannot read the branches of {repo_path}, it may be damaged\n")
         if exitOnERR:
             sys.exit()
-    proc_rcode = subprocess.call(['git','reset','--hard',f"{__remoteN}/{__branchN}"])
-    if proc_rcode != 0:
-        sys.stderr.write(f"Unexpected error occurred while attempting to fix Repository\n")
+        return False
+    branch, remote, upstream, old_commit = checked_out
+    # Repositories restored from the repository cache have no index and
+    # no working tree yet, so everything is checked out from scratch
+    restored = not os.path.exists(f'{repo_path}/.git/index')
+    remote = remote or 'origin'
+    if not upstream:
+        # A detached HEAD with no known default branch follows whatever the
+        # remote's HEAD points at
+        upstream = f"{remote}/{default_branch or branch or 'HEAD'}"
+
+    return_code, _, messages = run_git(['git', 'fetch', '--progress', '--prune', '--tags', remote] + get_fetch_args(strategy), repo_path)
+    for message in messages:
+        print(message)
+    if return_code != 0:
+        sys.stderr.write(f"Error: Fetching updates failed (Exit Code: {return_code})\n")
         if exitOnERR:
             sys.exit()
+        return False
 
-def attempt_update_repo():
-    # Git pull with submodules
-    _proc = subprocess.Popen(['git', 'pull', '--recurse-submodules'], stderr=subprocess.PIPE)
-    stderr = _proc.stderr.readline()
-    if stderr:
-        print(stderr)
-
-    # Update submodules recursively
-    _proc = subprocess.Popen(['git', 'submodule', 'update', '--init', '--recursive'], stderr=subprocess.PIPE)
-    stderr = _proc.stderr.readline()
-    if stderr:
-        print(stderr)
-
-    # Fetch all updates and prune stale references
-    _proc = subprocess.Popen(['git', 'fetch', '--all'], stderr=subprocess.PIPE)
-    stderr =  _proc.stderr.readline()
-    if stderr:
-        print(stderr)
-    _proc = subprocess.Popen(['git', 'fetch', '--prune', '--tags'], stderr=subprocess.PIPE)
-    stderr = _proc.stderr.readline()
-    if stderr:
-        print(stderr)
-
-def get_starred_repos():
-    repos = []
-    url = f'https://api.github.com/users/{GITHUB_USERNAME}/starred'
-    global NUM_API_PAGES
-    print("Starting to fetch starred repositories from GitHub...")
-    
-    while url:
-        print(f"Fetching repositories from {url}...")
-        
-        try:
-            # Request starred repositories
-            #response = requests.get(url, headers=Reqheaders, timeout=(5, 10))
-            response =  httpx.get(url, headers=Reqheaders, timeout=10)
-        
-            if response.status_code == 200:
-                repos_on_page = response.json()
-                if repos_on_page:
-                    repos.extend(repos_on_page)
-                    print(f"Found {len(repos_on_page)} repositories on this page.")
-                else:
-                    print(f"No more repositories found.")
-                    break
+    # Resetting also discards any local damage to the working tree
+    with timed_phase('fix'):
+        proc = subprocess.run(['git', 'reset', '--hard', upstream], cwd=repo_path, capture_output=True, text=True)
+    print(proc.stdout.strip())
+    if proc.returncode != 0:
+        sys.stderr.write(f"Unexpected error occurred while attempting to fix Repository: {proc.stderr.strip()}\n")
+        if exitOnERR:
+            sys.exit()
+        return False
 
-                # Check for pagination in the 'Link' header
-                link_header = response.headers.get('Link')
-                if link_header:
-                    url = None
-                    links = link_header.split(", ")
-                    for link in links:
-                        if 'rel="next"' in link:
-                            # Extract the next page URL
-                            url = link[link.find("<") + 1: link.find(">")]
-                            break
-                else:
-                    url = None
-            
-                if NUM_API_PAGES >= API_PAGES and API_PAGES != -1:
-                    print("No more pages to fetch.")
-                    break
-            
-                if not url:
-                    print("No more pages to fetch.")
-                    break
-                else:
-                    NUM_API_PAGES += 1
-            
-                # Fetch and handle rate limit information
-                remaining = int(response.headers.get('X-RateLimit-Remaining', 0))
-                print(f"Remaining requests: {remaining}")
-
-                # If we're out of requests, wait until the rate limit resets
-                if remaining == 0:
-                    # Calculate how long to wait until rate limit resets
-                    reset_time = int(response.headers.get('X-RateLimit-Reset', 0))
-                    reset_timestamp = datetime.fromtimestamp(reset_time)
-                    sleep_duration = (reset_timestamp - datetime.now()).total_seconds()
-                    print(f"Rate limit hit! Waiting for {int(sleep_duration)} seconds (until {reset_timestamp})...")
-                    time.sleep(sleep_duration)
-                else:
-                    # Add a cooldown of 2 .5seconds between calls to prevent hitting rate limits too quickly
-                    print("Waiting for 2 seconds and half before the next request...")
-                    time.sleep(2.5)
-            else:
-                sys.stderr.write(f"Error: Failed to fetch repositories (HTTP {response.status_code}).")
-                sys.stderr.write(f"Response content: {response.text}\n")
+    if os.path.exists(f'{repo_path}/.gitmodules'):
+        modules_changed = (restored or not os.path.isdir(f'{repo_path}/.git/modules') or submodules_changed(repo_path, old_commit)
+                           or submodules_out_of_date(repo_path))
+        if modules_changed:
+            print("Updating submodules...")
+            return_code, _, messages = run_git(['git', 'submodule', 'update', '--init', '--recursive', '--progress'] + get_fetch_args(strategy), repo_path)
+            for message in messages:
+                print(message)
+            if return_code != 0:
+                # Failing the update keeps the repository out of sync, so
+                # the submodules are tried again on the next run
+                sys.stderr.write(f"Error: Updating submodules failed (Exit Code: {return_code})\n")
+                if exitOnERR:
+                    sys.exit()
+                return False
+    return True
+
+class StarredRepo:
+    """Compact record of a starred repository: only the fields the sync
+    uses are kept from the API payload, which is discarded once parsed."""
+
+    FIELDS = ('id', 'full_name', 'clone_url', 'language', 'size', 'owner', 'pushed_at', 'updated_at',
+              'has_wiki', 'default_branch', 'archived', 'disabled', 'fork', 'parent', 'parent_url')
+    # sources: the listings referencing the repository, set when merging them
+    __slots__ = FIELDS + ('sources',)
+
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields.get(name))
+        self.sources = []
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    @classmethod
+    def from_api(cls, data):
+        return cls(
+            id=data.get('id'),  # Stable across renames and transfers
+            full_name=data['full_name'],  # Repo in format "owner/repo"
+            clone_url=data['clone_url'],
+            language=data.get('language'),
+            size=data.get('size'),  # Size of the repository in KB
+            owner=data['owner']['login'],
+            pushed_at=data.get('pushed_at'),
+            updated_at=data.get('updated_at'),
+            has_wiki=data.get('has_wiki'),
+            default_branch=data.get('default_branch'),
+            archived=data.get('archived', False),
+            disabled=data.get('disabled', False),
+            fork=data.get('fork', False),
+        )
+
+def get_link_urls(headers):
+    # Parse the 'Link' header into a {rel: url} mapping
+    links = {}
+    link_header = headers.get('Link')
+    if link_header:
+        for link in link_header.split(", "):
+            url = link[link.find("<") + 1: link.find(">")]
+            rel = link[link.find('rel="') + 5:].rstrip('"')
+            links[rel] = url
+    return links
+
+def get_page_url(url, page):
+    parts = urlparse(url)
+    query = parse_qs(parts.query)
+    query['page'] = [str(page)]
+    return urlunparse(parts._replace(query=urlencode(query, doseq=True)))
+
+def get_listing_url(source):
+    kind, name = source.split(':', 1)
+    if kind == 'org':
+        return f'{GITHUB_API_URL}/orgs/{name}/repos?type=all&per_page={API_PER_PAGE}'
+    return f'{GITHUB_API_URL}/users/{name}/starred?per_page={API_PER_PAGE}'
+
+async def fetch_listing_page(client, semaphore, url):
+    print(f"Fetching repositories from {url}...")
+    try:
+        response = await api_get_async(client, semaphore, url, Reqheaders)
+    except httpx.RequestError as e:
+        sys.stderr.write(f"Failed to fetch Repositories list from API: {e}\n")
+        return None
+    if response.status_code != 200:
+        sys.stderr.write(f"Error: Failed to fetch repositories (HTTP {response.status_code}).")
+        sys.stderr.write(f"Response content: {response.text}\n")
+        return None
+    print(f"Remaining requests: {response.headers.get('X-RateLimit-Remaining', 'unknown')}")
+    return response
+
+async def fetch_listing(client, semaphore, source, on_page):
+    # Fetch one source's listing, handing each page to on_page as a list of
+    # StarredRepo records as soon as it arrives. Pages already saved in the
+    # checkpoint are not fetched again.
+    url = get_listing_url(source)
+    listing = get_listing_checkpoint(source)
+    known_pages = set(listing['pages'])
+
+    async def fetch_page(page, page_url):
+        response = await fetch_listing_page(client, semaphore, page_url)
+        if response is not None and page not in known_pages:
+            on_page((source, page, [StarredRepo.from_api(data) for data in response.json()]))
+        return response
+
+    if 1 in known_pages and listing['last_page']:
+        links = {'last': get_page_url(url, listing['last_page'])}
+    else:
+        response = await fetch_page(1, url)
+        if response is None:
+            return
+        links = get_link_urls(response.headers)
+        if not links.get('next'):
+            listing['last_page'] = 1
+
+    if 'last' in links:
+        # The last page number is known, so fetch the remaining pages concurrently
+        last_page = int(parse_qs(urlparse(links['last']).query).get('page', ['1'])[0])
+        if API_PAGES != -1:
+            last_page = min(last_page, API_PAGES)
+        listing['last_page'] = last_page
+        missing_pages = [page for page in range(2, last_page + 1) if page not in known_pages]
+        print(f"Fetching {len(missing_pages)} of {last_page} pages of {source} with up to {API_JOBS} concurrent requests...")
+        await asyncio.gather(*(fetch_page(page, get_page_url(links['last'], page)) for page in missing_pages))
+    else:
+        # No page count advertised, follow the 'next' links one by one
+        num_pages = 1
+        while 'next' in links and (API_PAGES == -1 or num_pages < API_PAGES):
+            response = await fetch_page(num_pages + 1, links['next'])
+            if response is None:
                 break
-        except httpx.RequestError as e:
-            sys.stderr.write(f"Failed to fetch Repositories list from API: {e}\n")
-        """except requests.RequestException as e:
+            num_pages += 1
+            links = get_link_urls(response.headers)
+        if 'next' not in links:
+            listing['last_page'] = num_pages
+
+async def fetch_listings(sources, on_page):
+    # All listings share one connection pool and one concurrency limit
+    semaphore = asyncio.Semaphore(API_JOBS)
+    limits = httpx.Limits(max_connections=API_JOBS, max_keepalive_connections=API_JOBS)
+    async with httpx.AsyncClient(http2=HTTP2, timeout=10, limits=limits) as client:
+        await asyncio.gather(*(fetch_listing(client, semaphore, source, on_page) for source in sources))
+
+def read_repo_list(path):
+    # One owner/name per line; blank lines and '#' comments are ignored
+    repo_names = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            repo_name = line.split('#', 1)[0].strip()
+            if repo_name:
+                repo_names.append(repo_name)
+    return list(dict.fromkeys(repo_names))
+
+def fetch_repo_list(source):
+    # Repository lists carry no metadata, so all of it comes from GraphQL
+    repo_names = read_repo_list(source.split(':', 1)[1])
+    with timed_phase('metadata'):
+        metadata = fetch_repos_metadata(repo_names)
+    return [StarredRepo(full_name=repo_name, owner=repo_name.split('/')[0], **metadata[repo_name])
+            for repo_name in repo_names if repo_name in metadata]
+
+def get_work_set():
+    # Stream the repositories to sync: the listings are fetched in a
+    # background thread and repositories are yielded page by page while
+    # they continue. With several sources the work set is merged first, so
+    # that each repository is yielded once, with every source listing it.
+    # Pages kept in the checkpoint are replayed first and repositories
+    # completed before an interruption are left out.
+    print(f"Starting to fetch repositories from GitHub for {', '.join(SOURCES)}...")
+    pages = queue.Queue()
+    for source in SOURCES:
+        # Saved pages are read back one at a time as they are consumed
+        for page in sorted(get_listing_checkpoint(source)['pages']):
+            pages.put((source, page, None))
+
+    def fetch_pages():
+        try:
+            with timed_phase('listing'):
+                for source in SOURCES:
+                    if source.startswith('list:') and 1 not in get_listing_checkpoint(source)['pages']:
+                        pages.put((source, 1, fetch_repo_list(source)))
+                api_sources = [source for source in SOURCES if not source.startswith('list:')]
+                if api_sources:
+                    asyncio.run(fetch_listings(api_sources, pages.put))
+        except Exception as e:
             sys.stderr.write(f"Failed to fetch Repositories list from API: {e}\n")
-        except requests.exceptions.Timeout:
-            print("Timed out...")"""
-            
-    print(f"\nFinished fetching repositories. Total repositories found: {len(repos)}.")
-    return repos
-
-def check_for_wiki(repo_name, headers):
-    # URL for the repository information
-    repo_api_url = f"https://api.github.com/repos/{repo_name}"
-    
-    try:
-        # Request repository data
-        #response = requests.get(repo_api_url, headers=Reqheaders)
-        response =  httpx.get(repo_api_url, headers=headers, timeout=10)
-        
-        if response.status_code == 200:
-            repo_data = response.json()
-            
-            #print(f"Repository data for {repo_name}: {json.dumps(repo_data, indent=2)}")
-
-            # Fetch and handle rate limit information
-            remaining = int(response.headers.get('X-RateLimit-Remaining', 0))
-            print(f"Remaining requests: {remaining}")
-
-            # If we're out of requests, wait until the rate limit resets
-            if remaining == 0:
-                # Calculate how long to wait until rate limit resets
-                reset_time = int(response.headers.get('X-RateLimit-Reset', 0))
-                reset_timestamp = datetime.fromtimestamp(reset_time)
-                sleep_duration = (reset_timestamp - datetime.now()).total_seconds()
-                print(f"Rate limit hit! Waiting for {int(sleep_duration)} seconds (until {reset_timestamp})...")
-                time.sleep(sleep_duration)
-            else:
-                # Check if the repository has a wiki enabled
-                if repo_data.get("has_wiki", True):
-                    print(f"Wiki is enabled for {repo_name}.")
-                    return True
-                else:
-                    print(f"No wiki available for {repo_name}.")
-                    return False
-        else:
-            print(f"Error fetching repository data: {response.status_code} - {response.text}")
-            return False
-    except Exception as e:
-        print(f"Error occurred while checking for wiki: {e}")
-        return False
+        finally:
+            pages.put(None)
 
-def clone_repo_with_wiki(repo_url, repo_name, language, owner):
-    # Set the folder name as "User@RepoName"
-    folder_name = f"{owner}@{repo_name.split('/')[-1]}"
+    threading.Thread(target=fetch_pages, name='listing', daemon=True).start()
 
-    # Check if the repository has a wiki
-    if check_for_wiki(repo_name, Reqheaders):
-        wiki_url = repo_url.replace('.git', '.wiki.git')
-        wiki_folder = f'{folder_name}-Wiki'
-        
-        # Directory for the language, default to "Unknown" if no language specified
-        if not language:
-            language = "Unknown"
-    
-        # Create language directory if it doesn't exist
-        if not os.path.exists(f'{original_dir}/{language}'):
-            print(f"Creating directory: {language}")
-            os.makedirs(f'{original_dir}/{language}')
-    
-        # Change into the language directory
-        print(f"Changing to directory: {language}")
-        os.chdir(f'{original_dir}/{language}')
-        
-        if not os.path.exists(wiki_folder):
-            print(f"Cloning the wiki into {wiki_folder}...")
+    batch_mode = len(SOURCES) > 1
+    work_set = {}
+    total = 0
+    while True:
+        item = pages.get()
+        if item is None:
+            break
+        source, page, repos_on_page = item
+        saved = repos_on_page is None
+        if saved:
+            repos_on_page = load_listing_page(source, page)
+        new_repos = []
+        for repo in repos_on_page:
+            known_repo = work_set.get(repo.full_name)
+            if known_repo is None:
+                repo.sources = [source]
+                work_set[repo.full_name] = repo
+                new_repos.append(repo)
+            elif source not in known_repo.sources:
+                known_repo.sources.append(source)
+        fill_repos_metadata(new_repos)
+        if not saved:
+            print(f"Found {len(repos_on_page)} repositories on page {page} of {source}.")
+            save_listing_page(source, page, repos_on_page)
+        total += len(repos_on_page)
+        if not batch_mode:
+            for repo in new_repos:
+                if repo.full_name not in checkpoint['completed']:
+                    yield repo
 
-            # Clone the wiki repo
-            wiki_clone_command = ['git', 'clone','--progress', wiki_url, wiki_folder]
+    print(f"\nFinished fetching repositories. Total repositories found: {total}.")
+    if batch_mode:
+        print(f"{len(work_set)} unique repositories across {len(SOURCES)} sources.")
+        for repo in work_set.values():
+            if repo.full_name not in checkpoint['completed']:
+                yield repo
 
-            # Add the --depth option if cloning depth is specified
-            if CLONE_DEPTH is not None:
-                wiki_clone_command += ['--depth', str(CLONE_DEPTH)]
+GRAPHQL_BATCH_SIZE = 100
+GRAPHQL_REPO_FIELDS = """
+fragment RepoMetadata on Repository {
+  databaseId
+  nameWithOwner
+  url
+  primaryLanguage { name }
+  updatedAt
+  hasWikiEnabled
+  defaultBranchRef { name }
+  pushedAt
+  diskUsage
+  isArchived
+  isDisabled
+  isFork
+  parent { nameWithOwner url }
+}"""
 
-            print(f"Executing command: {' '.join(wiki_clone_command)}")
-            try:
-                wiki_process = subprocess.Popen(wiki_clone_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-                _, wiki_stderr =  wiki_process.communicate()
+def fetch_repos_metadata(repo_names):
+    # Look up repository metadata with one GraphQL query per batch of
+    # repositories instead of one REST call per repository
+    metadata = {}
+    for start in range(0, len(repo_names), GRAPHQL_BATCH_SIZE):
+        batch = repo_names[start:start + GRAPHQL_BATCH_SIZE]
+        fields = []
+        for i, repo_name in enumerate(batch):
+            owner, name = repo_name.split('/', 1)
+            fields.append(f"r{i}: repository(owner: {json.dumps(owner)}, name: {json.dumps(name)}) {{ ...RepoMetadata }}")
+        query = "query {\n" + "\n".join(fields) + "\n}" + GRAPHQL_REPO_FIELDS
+        print(f"Fetching metadata for {len(batch)} repositories...")
+        try:
+            response = api_post(GITHUB_GRAPHQL_URL, Reqheaders, {'query': query})
+        except httpx.RequestError as e:
+            sys.stderr.write(f"Failed to fetch repository metadata from API: {e}\n")
+            continue
+        if response.status_code != 200:
+            sys.stderr.write(f"Error: Failed to fetch repository metadata (HTTP {response.status_code}): {response.text}\n")
+            continue
+        data = response.json().get('data') or {}
+        for i, repo_name in enumerate(batch):
+            repo_data = data.get(f"r{i}")
+            if not repo_data:
+                print(f"No metadata available for {repo_name}.")
+                continue
+            # A node without its URL cannot be cloned; anything else missing
+            # is left unknown
+            if not repo_data.get('url'):
+                sys.stderr.write(f"Warning: Incomplete metadata for {repo_name}, skipping it.\n")
+                continue
+            parent = repo_data.get('parent') or {}
+            metadata[repo_name] = {
+                'id': repo_data.get('databaseId'),
+                'clone_url': f"{repo_data['url']}.git",
+                'language': (repo_data.get('primaryLanguage') or {}).get('name'),
+                'updated_at': repo_data.get('updatedAt'),
+                'has_wiki': repo_data.get('hasWikiEnabled'),
+                'default_branch': (repo_data.get('defaultBranchRef') or {}).get('name'),
+                'pushed_at': repo_data.get('pushedAt'),
+                'size': repo_data.get('diskUsage'),
+                'archived': repo_data.get('isArchived'),
+                'disabled': repo_data.get('isDisabled'),
+                'fork': repo_data.get('isFork'),
+                'parent': parent.get('nameWithOwner'),
+                'parent_url': f"{parent['url']}.git" if parent.get('url') else None,
+            }
+    return metadata
 
+FILLED_FIELDS = ('id', 'has_wiki', 'default_branch', 'parent', 'parent_url')
 
-                if wiki_process.returncode != 0 or wiki_stderr:
-                    if wiki_process.returncode == 128:
-                        print(f"Wiki clone is possibly failed (Code {wiki_process.returncode})")
-                    else:
-                        print(f"Wiki clone is possibly failed (Code {wiki_process.returncode}): {wiki_stderr}")
-                else:
-                    print(f"Wiki successfully cloned into {wiki_folder}")
-            except subprocess.CalledProcessError as e:
-                sys.stderr.write(f"Error: Subprocess error occurred while cloning Wiki of {repo_url}. Error: {e.stderr} (Exit Code: {e.returncode})\n")
-                if exitOnERR:
-                    sys.exit()
-            except Exception as ex:
-                sys.stderr.write(f"Unexpected error occurred while cloning Wiki of {repo_url}: {ex}\n")
-                if exitOnERR:
-                    sys.exit()
-        else:
-            if os.path.exists(f'{folder_name}/.git'):
-                print(f"Wiki Directory {wiki_folder} is already created earlier and is a Git Repository")
-            else:
-                print(f"Wiki Directory {wiki_folder} is already created earlier for some reason")
-        # Move back to the original directory
-        print(f"Returning to the parent directory.")
-        os.chdir(original_dir) 
+def fill_repos_metadata(repos):
+    # The listings already carry this metadata; only entries missing it
+    # are looked up, plus the parents of forks in mirror mode. Fields the
+    # listing has (even as null, like a missing language) are kept.
+    missing = [repo for repo in repos if repo.has_wiki is None or (mirrorMode and repo.fork and repo.parent is None)]
+    if missing:
+        with timed_phase('metadata'):
+            metadata = fetch_repos_metadata([repo.full_name for repo in missing])
+        for repo in missing:
+            for name, value in metadata.get(repo.full_name, {}).items():
+                if name in FILLED_FIELDS and getattr(repo, name) is None:
+                    setattr(repo, name, value)
+
+# Answers meaning there is no wiki to read: GitHub says 'not found' for
+# wikis without pages, git daemon 'no such repository' or 'not exported',
+# and HTTPS asks for credentials (refused without a terminal) for wikis the
+# token cannot read
+WIKI_MISSING_ERRORS = ('not found', 'does not appear to be a git repository', 'no such repository',
+                       'repository not exported', 'could not read username', 'terminal prompts disabled')
+# Wikis whose probe failed otherwise are retried after this many seconds
+WIKI_FAILED_TTL = 86400
+
+def probe_wiki(wiki_url):
+    # The commit the wiki's HEAD points at, '' when there is no wiki, None
+    # on other errors
+    with git_slots:
+        proc = subprocess.run(['git', 'ls-remote', wiki_url, 'HEAD'], capture_output=True, text=True,
+                              env={**os.environ, 'GIT_TERMINAL_PROMPT': '0'})
+    count_metric('wiki_probes')
+    if proc.returncode == 0:
+        return proc.stdout.split('\t', 1)[0].strip()
+    if any(error in proc.stderr.lower() for error in WIKI_MISSING_ERRORS):
+        return ''
+    sys.stderr.write(f"Error: Could not probe the wiki at {wiki_url}: {proc.stderr.strip()}\n")
+    return None
+
+def sync_wiki(repo, folder_name, strategy='full'):
+    # Wikis go through the same clone and update path as repositories. An
+    # ls-remote first tells whether the wiki exists and whether it changed;
+    # missing wikis are remembered for WIKI_PROBE_TTL before probing again,
+    # wikis that could not be probed for WIKI_FAILED_TTL.
+    if not repo.has_wiki:
+        return None
+    wiki_url = f"{repo.clone_url.removesuffix('.git')}.wiki.git"
+    wiki_path = f"{original_dir}/{repo.language or 'Unknown'}/{folder_name}-Wiki"
+    metadata = get_cloned_repo(folder_name) or {}
+    if not is_git_repo(wiki_path):
+        for field, ttl, reason in (('wiki_missing_at', WIKI_PROBE_TTL, 'No wiki available'), ('wiki_failed_at', WIKI_FAILED_TTL, 'Wiki could not be reached')):
+            checked_at = metadata.get(field)
+            if checked_at and time.time() - datetime.fromisoformat(checked_at).timestamp() < ttl:
+                print(f"{reason} for {repo.full_name} (checked {checked_at}).")
+                return None
 
-def clone_repo(repo_url, repo_name, language, owner):
+    remote_head = probe_wiki(wiki_url)
+    if remote_head is None:
+        return 'unreachable'
+    if not remote_head:
+        print(f"No wiki available for {repo.full_name}.")
+        return 'missing'
+    # A wiki without an index was restored and still needs its checkout
+    if os.path.exists(f'{wiki_path}/.git/index') and get_head_commit(wiki_path) == remote_head:
+        print(f"Wiki of {repo.full_name} is up to date.")
+        return 'unchanged'
+
+    restored = not is_git_repo(wiki_path) and restore_from_cache(repo.id, wiki_path, wiki_url, '.wiki')
+    status = clone_or_update(wiki_url, f"{repo.full_name} wiki", wiki_path, strategy)
+    return 'restored' if restored and status == 'updated' else status
+
+def get_wiki_fields(wiki_status):
+    # State fields recording the outcome of a wiki sync
+    if wiki_status == 'missing':
+        return {'wiki_missing_at': datetime.now().isoformat(timespec='seconds')}
+    if wiki_status == 'unreachable':
+        return {'wiki_failed_at': datetime.now().isoformat(timespec='seconds')}
+    return {}
+
+def clone_repo(repo_url, repo_name, language, owner, strategy='full', default_branch=None):
     # Directory for the language, default to "Unknown" if no language specified
     if not language:
         language = "Unknown"
@@ -336,161 +1483,60 @@ def clone_repo(repo_url, repo_name, language, owner):
     # Create language directory if it doesn't exist
     if not os.path.exists(f'{original_dir}/{language}'):
         print(f"Creating directory: {language}")
-        os.makedirs(f'{original_dir}/{language}')
-    
-    # Change into the language directory
-    print(f"Changing to directory: {language}")
-    os.chdir(f'{original_dir}/{language}')
+        os.makedirs(f'{original_dir}/{language}', exist_ok=True)
 
     # Set the folder name as "User@RepoName"
     folder_name = f"{owner}@{repo_name.split('/')[-1]}"
     repo_path = f"{original_dir}/{language}/{folder_name}"
-    if os.path.exists(f'{repo_path}/.git') or is_repo_cloned(folder_name):
+    return clone_or_update(repo_url, repo_name, repo_path, strategy, default_branch, folder_name)
+
+def clone_or_update(repo_url, repo_name, repo_path, strategy='full', default_branch=None, state_name=None):
+    # Shared by repositories and wikis: update an existing clone with a
+    # single fetch, or clone into repo_path
+    folder_name = os.path.basename(repo_path)
+    if os.path.exists(f'{repo_path}/.git'):
         print(f"{folder_name} is already cloned, proceeding...")
-        try:
-            os.chdir(repo_path)
-            print(f"Attempting to fix any problem on {repo_name}...")
-            attempt_fix_repo()
-            print(f"Updating repository {repo_name}...")
-            attempt_update_repo()
-            print(f"Repository {repo_name} updated successfully.\n")
-        finally:
-            print("Returning to the parent directory.")
-            os.chdir(original_dir)
-        return
+        print(f"Updating repository {repo_name}...")
+        if not attempt_update_repo(repo_path, strategy, default_branch):
+            return 'failed'
+        print(f"Repository {repo_name} updated successfully.\n")
+        return 'updated'
 
     # Create the repository directory
     if not os.path.exists(repo_path):
         print(f"Creating repository directory: {folder_name}")
         os.makedirs(repo_path)
-    else:
-        if os.path.exists(f'{folder_name}/.git'):
-            print(f"Directory {folder_name} is already created earlier and is a Git Repository")
-            
-            os.chdir(original_dir) 
-            if not is_repo_cloned(folder_name):
-                save_cloned_repo(folder_name)
-            #return
+    elif os.listdir(repo_path):
+        # Only leftovers this tool provably wrote are discarded: a clone
+        # still marked in flight, or one recorded as failed at this path.
+        # Anything else is not ours to overwrite, and is not recorded as a
+        # failed clone either.
+        metadata = (get_cloned_repo(state_name) if state_name else None) or {}
+        own_failure = metadata.get('clone_failed') and metadata.get('path') == os.path.relpath(repo_path, original_dir)
+        if own_failure or repo_path in checkpoint['in_flight']:
+            print(f"Directory {folder_name} holds a failed earlier clone, discarding it")
+            shutil.rmtree(repo_path)
+            os.makedirs(repo_path)
         else:
-            print(f"Directory {folder_name} is already created earlier for some reason")
-            os.chdir(original_dir) 
+            sys.stderr.write(f"Error: Directory {folder_name} is already created earlier for some reason and is not empty\n")
+            return 'blocked'
 
-    # Change into the repository directory
-    os.chdir(repo_path)
-    
     # Prepare the git clone command
-    git_command = ['git', 'clone', '--progress', repo_url, '.']  # Clone directly into the current directory
+    git_command = ['git', 'clone', '--progress', repo_url, '.']  # Clone directly into the repository directory
     
-    # Add the --depth option if cloning depth is specified
-    if CLONE_DEPTH is not None:
-        git_command += ['--depth', str(CLONE_DEPTH)]
+    # Add the options of the clone strategy
+    print(f"Using {strategy} clone strategy")
+    git_command += get_clone_args(strategy)
 
     print(f"Executing command: {' '.join(git_command)}")
     
-    # Execute the git clone command and capture the output
+    # Execute the git clone command, following its progress output
+    return_code = None
+    mark_in_flight(repo_path, repo_name)
     try:
-        # Start the git clone process using subprocess.Popen to capture real-time output
-        process = subprocess.Popen(
-            git_command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=False,
-            bufsize=1,  # Line-buffered
-            encoding='utf-8'
-        )
-
-        # Variables to store progress info
-        total_objects = 0
-        compressed_objects = 0
-        total_cobjects = 0
-        total_deltas = 0
-        reused_objects = 0
-        reused_deltas = 0
-        reused_pobjects = 0
-        rsv_delt_percent = 0
-        rsv_delt_resolved = 0
-        rsv_delt_total = 0
-        rcv_obj_percent = 0
-        rcv_obj_received = 0
-        rcv_obj_total = 0
-        rcv_obj_size = 0
-        rcv_obj_size_unit = 0
-        rcv_obj_speed = 0
-        rcv_obj_speed_unit = 0
-
-        # Real-time printing of the git clone process
-        while True:
-            output = process.stdout.readline()
-            if isinstance(output, bytes):
-                line = output.decode('utf-8', errors='replace')
-            else:
-                line = output
-            error_output = process.stderr.readline()
-
-            if '\r' in line:
-                line = line.split('\r')[-1]
-                line = line.strip()
-
-            # Analyze stdout for specific information
-            if line:
-                # Match counting objects
-                match = counting_objects_re.search(line)
-                if match:
-                    total_cobjects = int(match.group(1))
-                    continue
-
-                # Match compressing objects
-                match = compressing_objects_re.search(line)
-                if match:
-                    compressed_objects = int(match.group(1))
-                    continue
-                
-                # Match delta information
-                match = deltas_re.search(line)
-                if match:
-                    total_objects = int(match.group(1))
-                    total_deltas = int(match.group(2))
-                    reused_objects = int(match.group(3))
-                    reused_deltas = int(match.group(4))
-                    reused_pobjects = int(match.group(5))
-                    continue
-
-                # Match receiving objects
-                match = recv_objects_re.search(line)
-                if match:
-                    rcv_obj_percent = int(match.group(1))
-                    rcv_obj_received = int(match.group(2))
-                    rcv_obj_total = int(match.group(3))
-                    rcv_obj_size = int(match.group(4))
-                    rcv_obj_size_unit = int(match.group(5))
-                    rcv_obj_speed = int(match.group(6))
-                    rcv_obj_speed_unit = int(match.group(7))
-                    continue
-
-                # Match resolving deltas
-                match = resv_deltas_re.search(line)
-                if match:
-                    rsv_delt_percent = int(match.group(1))
-                    rsv_delt_resolved = int(match.group(2))
-                    rsv_delt_total = int(match.group(3))
-                    continue
-
-            print(f"remote: Counting objects: {total_cobjects}\n")
-            print(f"remote: Compressing objects: {compressed_objects}%\n")
-            print(f"Total {total_objects} (delta {total_deltas}), reused {reused_objects} (delta {reused_deltas}), pack-reused {reused_pobjects}\n")
-            print(f"Receiving objects: {rcv_obj_percent}% ({rcv_obj_received}/{rcv_obj_total}), {rcv_obj_size} {rcv_obj_size_unit} | {rcv_obj_speed} {rcv_obj_speed_unit}/s\n")
-            print(f"Resolving deltas: {rsv_delt_percent}% ({rsv_delt_resolved}/{rsv_delt_total}), done\n")
-            sys.stdout.flush()
-
-            if error_output:
-                print(f"[stderr] {error_output.strip()}")
-
-            # Break the loop if the process is finished and both stdout and stderr are done
-            if process.poll() is not None and not line and not error_output:
-                break
-
-        # Final exit code of the git clone process
-        return_code = process.wait()
+        return_code, _, messages = run_git(git_command, repo_path)
+        for message in messages:
+            print(f"[stderr] {message}")
 
         """
         # Check the size of the shallow clone
@@ -506,8 +1552,7 @@ def clone_repo(repo_url, repo_name, language, owner):
         """
 
         if return_code == 0:
-            save_cloned_repo(folder_name)
-            print(f"Success: {repo_name} successfully cloned into '{original_dir}/{language}/{folder_name}'")
+            print(f"Success: {repo_name} successfully cloned into '{repo_path}'")
     except subprocess.CalledProcessError as e:
         sys.stderr.write(f"Error: Subprocess error occurred while cloning {repo_url}. Error: {e.stderr} (Exit Code: {e.returncode})\n")
         if exitOnERR:
@@ -516,54 +1561,992 @@ def clone_repo(repo_url, repo_name, language, owner):
         sys.stderr.write(f"Unexpected error occurred while cloning {repo_url}: {ex}\n")
         if exitOnERR:
             sys.exit()
+    finally:
+        clear_in_flight(repo_path)
 
-    if os.path.exists(f'{folder_name}/.git'):
-        print(f"Attempting  to fix any problem on {repo_name}...")
-        attempt_fix_repo()
-    
-    # Move back to the original directory
-    print(f"Returning to the parent directory.")
-    os.chdir(original_dir) 
+    return 'cloned' if return_code == 0 else 'failed'
 
-def main():
-    print(f"\nStarting process for user: {GITHUB_USERNAME}")
-    
-    # Get the starred repositories list
-    starred_repos = get_starred_repos()
-    
-    if not starred_repos:
-        sys.stderr.write("No repositories found or error fetching data.\n")
+def is_git_repo(repo_path):
+    # Working copies have a .git directory, bare mirrors hold HEAD and objects directly
+    return os.path.exists(f'{repo_path}/.git') or (os.path.exists(f'{repo_path}/HEAD') and os.path.isdir(f'{repo_path}/objects'))
+
+def get_repo_path(repo):
+    folder_name = f"{repo.owner}@{repo.full_name.split('/')[-1]}"
+    repo_path = f"{original_dir}/{repo.language or 'Unknown'}/{folder_name}"
+    return f"{repo_path}.git" if mirrorMode else repo_path
+
+# Git directories of repositories that leave the archive are kept here as
+# bare repositories named after the GitHub repository ID, so that a
+# repository coming back is restored locally and only fetches what changed
+REPO_CACHE_DIR = '.repo-cache'
+
+def get_cache_repo_path(repo_id, suffix=''):
+    # Mirrors are kept apart, their refs layout differs from a working
+    # copy's. Wikis (suffix '.wiki') are working copies in every mode.
+    if mirrorMode and not suffix:
+        suffix += '.mirror'
+    return f"{original_dir}/{REPO_CACHE_DIR}/{repo_id}{suffix}.git"
+
+def stash_repo(repo_id, repo_path, suffix=''):
+    # Move a repository's git directory into the repository cache and drop
+    # its working tree
+    if repo_id is None or not is_git_repo(repo_path):
+        return False
+    cache_path = get_cache_repo_path(repo_id, suffix)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    git_dir = get_git_dir(repo_path)
+    print(f"Keeping {repo_path} in the repository cache as {os.path.basename(cache_path)}")
+    with accounted_size(cache_path, suffix):
+        os.replace(git_dir, cache_path)
+    subprocess.run(['git', 'config', 'core.bare', 'true'], cwd=cache_path, capture_output=True)
+    # Cache entries are evicted by age from here on
+    os.utime(cache_path)
+    if os.path.exists(repo_path):
+        shutil.rmtree(repo_path)
+    return True
+
+def restore_from_cache(repo_id, repo_path, repo_url, suffix=''):
+    # Move a cached git directory back into place. The repository then only
+    # needs updating: its working tree is checked out by the next reset.
+    cache_path = get_cache_repo_path(repo_id, suffix) if repo_id is not None else None
+    if cache_path is None or not os.path.isdir(cache_path):
+        return False
+    if os.path.exists(repo_path) and os.listdir(repo_path):
+        return False
+    print(f"Restoring {repo_path} from the repository cache...")
+    os.makedirs(os.path.dirname(repo_path), exist_ok=True)
+    with accounted_size(cache_path, suffix):
+        if mirrorMode and not suffix:
+            if os.path.exists(repo_path):
+                os.rmdir(repo_path)
+            os.replace(cache_path, repo_path)
+        else:
+            os.makedirs(repo_path, exist_ok=True)
+            os.replace(cache_path, f'{repo_path}/.git')
+            subprocess.run(['git', 'config', 'core.bare', 'false'], cwd=repo_path, capture_output=True)
+            # The index described a working tree that is gone
+            if os.path.exists(f'{repo_path}/.git/index'):
+                os.remove(f'{repo_path}/.git/index')
+            # Bare repositories have no remote-tracking refspec to update from
+            if subprocess.run(['git', 'config', '--get', 'remote.origin.fetch'], cwd=repo_path, capture_output=True).returncode != 0:
+                subprocess.run(['git', 'config', 'remote.origin.fetch', '+refs/heads/*:refs/remotes/origin/*'], cwd=repo_path, capture_output=True)
+    subprocess.run(['git', 'remote', 'set-url', 'origin', repo_url], cwd=repo_path, capture_output=True)
+    count_metric('repos_restored')
+    return True
+
+def find_previous_path(repo, folder_name, repo_path):
+    # Where the repository was archived before, when that is not repo_path:
+    # its recorded path, found by name or by ID (renamed and transferred
+    # repositories), or the same folder under another language directory
+    # A folder name recorded for another repository's ID is not this one's
+    same_name = not is_other_repo(get_cloned_repo(folder_name), repo)
+    candidates = []
+    for name in (folder_name if same_name else None, find_cloned_repo_by_id(repo.id) if repo.id is not None else None):
+        metadata = get_cloned_repo(name) if name else None
+        if metadata and metadata.get('path'):
+            candidates.append(f"{original_dir}/{metadata['path']}")
+    if same_name:
+        candidates += glob.glob(f"{original_dir}/*/{glob.escape(os.path.basename(repo_path))}")
+    for path in candidates:
+        if os.path.abspath(path) != os.path.abspath(repo_path) and is_git_repo(path):
+            return path
+    return None
+
+def relocate_repo(repo, folder_name, repo_path):
+    # A repository whose path changed (GitHub reclassified its language, it
+    # was renamed or transferred, or it comes back from .unstarred) is moved
+    # with its wiki instead of cloned again, and fetches from its new URL
+    old_path = find_previous_path(repo, folder_name, repo_path)
+    if old_path is None:
+        return False
+    old_folder_name = os.path.basename(old_path).removesuffix('.git') if mirrorMode else os.path.basename(old_path)
+    old_wiki_path = f"{os.path.dirname(old_path)}/{old_folder_name}-Wiki"
+    wiki_path = f"{original_dir}/{repo.language or 'Unknown'}/{folder_name}-Wiki"
+    if os.path.exists(repo_path) and (is_git_repo(repo_path) or os.listdir(repo_path)):
+        # Something else already lives there; keep the old copy's objects
+        stash_repo(repo.id, old_path)
+        stash_repo(repo.id, old_wiki_path, '.wiki')
+        return False
+    print(f"Moving {old_path} to {repo_path}...")
+    if os.path.exists(repo_path):
+        os.rmdir(repo_path)
+    os.renames(old_path, repo_path)
+    if repo.clone_url:
+        subprocess.run(['git', 'remote', 'set-url', 'origin', repo.clone_url], cwd=repo_path, capture_output=True)
+    if os.path.exists(old_wiki_path) and not os.path.exists(wiki_path):
+        os.renames(old_wiki_path, wiki_path)
+        if repo.clone_url:
+            wiki_url = f"{repo.clone_url.removesuffix('.git')}.wiki.git"
+            subprocess.run(['git', 'remote', 'set-url', 'origin', wiki_url], cwd=wiki_path, capture_output=True)
+    old_name = find_cloned_repo_by_id(repo.id) if repo.id is not None else None
+    if old_name and old_name != folder_name:
+        rename_cloned_repo(old_name, folder_name)
+    count_metric('repos_moved')
+    return True
+
+def displace_repo(folder_name):
+    # The folder (and wiki) recorded under a repository's name belong to
+    # the repository that had this name before. They go to the repository
+    # cache under that repository's ID, to be restored when it is synced
+    # under its new name, and its record is dropped so that neither is
+    # taken for the other.
+    metadata = get_cloned_repo(folder_name)
+    repo_path = get_recorded_path(folder_name)
+    print(f"{folder_name} now names another repository, moving the copy of the previous one (ID {metadata['id']}) aside...")
+    if repo_path:
+        old_folder_name = os.path.basename(repo_path).removesuffix('.git') if mirrorMode else os.path.basename(repo_path)
+        stash_repo(metadata['id'], repo_path)
+        stash_repo(metadata['id'], f"{os.path.dirname(repo_path)}/{old_folder_name}-Wiki", '.wiki')
+    forget_cloned_repo(folder_name)
+    account_sync(0, -(metadata.get('disk_size') or 0))
+    count_metric('repos_displaced')
+
+pool_locks = {}
+pool_locks_lock = threading.Lock()
+fetched_pools = set()
+
+def get_pool_path(repo_name):
+    return f"{original_dir}/{OBJECT_POOLS_DIR}/{repo_name.replace('/', '@')}.git"
+
+def get_pool_lock(pool_path):
+    # Held while a pool is filled and while its parent's mirror is fetched
+    # into, so that a pool is never filled from a mirror being updated
+    with pool_locks_lock:
+        return pool_locks.setdefault(pool_path, threading.Lock())
+
+def find_local_mirror(repo_name):
+    # The archived mirror of a repository, in any language directory
+    for path in glob.glob(f"{original_dir}/*/{glob.escape(repo_name.replace('/', '@'))}.git"):
+        if is_git_repo(path):
+            return path
+    return None
+
+def share_with_pool(repo_path, pool_path):
+    # Copy a parent's objects from its local mirror into the pool of its
+    # fork network, then have the mirror borrow them from the pool and drop
+    # its own copies, so that the parent's history is stored once
+    with accounted_size(pool_path):
+        return_code, _, messages = run_git(['git', 'fetch', '--tags', repo_path, '+refs/heads/*:refs/heads/*'], pool_path, transfer=False)
+    if return_code != 0:
+        print(f"Could not fill the object pool from {repo_path}: {' '.join(messages)}")
+        return False
+    alternates = f"{repo_path}/objects/info/alternates"
+    pool_objects = f"{pool_path}/objects"
+    linked = []
+    if os.path.exists(alternates):
+        with open(alternates, 'r', encoding='utf-8') as file:
+            linked = [os.path.realpath(line.strip()) for line in file if line.strip()]
+    if os.path.realpath(pool_objects) not in linked:
+        os.makedirs(os.path.dirname(alternates), exist_ok=True)
+        with open(alternates, 'a', encoding='utf-8') as file:
+            file.write(pool_objects + '\n')
+    # -l leaves out every object the pool has
+    proc = subprocess.run(['git', 'repack', '-a', '-d', '-l', '-q'], cwd=repo_path, capture_output=True, text=True)
+    if proc.returncode != 0:
+        print(f"Could not repack {repo_path} against its object pool: {proc.stderr.strip()}")
+    # The mirror shrank by what it now borrows
+    folder_name = os.path.basename(repo_path).removesuffix('.git')
+    previous_disk_size = (get_cloned_repo(folder_name) or {}).get('disk_size')
+    if ARCHIVE_QUOTA is not None and previous_disk_size is not None:
+        disk_size = get_disk_size(repo_path)
+        update_cloned_repo(folder_name, disk_size=disk_size)
+        account_sync(0, disk_size - previous_disk_size)
+    return True
+
+def prepare_object_pool(parent_name, parent_url):
+    # Make sure the pool for a fork network exists and holds the parent's
+    # objects, filling it at most once per run. A parent archived here fills
+    # it locally; only parents that are not are fetched from the network.
+    pool_path = get_pool_path(parent_name)
+    with get_pool_lock(pool_path):
+        if pool_path in fetched_pools:
+            return pool_path
+        if not os.path.exists(pool_path):
+            print(f"Creating object pool for {parent_name}...")
+            os.makedirs(pool_path)
+            subprocess.run(['git', 'init', '--quiet', '--bare'], cwd=pool_path, check=True)
+            # Forks borrow objects from the pool, so it must never drop any
+            subprocess.run(['git', 'config', 'gc.pruneExpire', 'never'], cwd=pool_path, check=True)
+            subprocess.run(['git', 'config', 'gc.auto', '0'], cwd=pool_path, check=True)
+        parent_path = find_local_mirror(parent_name)
+        if parent_path:
+            print(f"Filling the object pool of {parent_name} from its mirror...")
+            if not share_with_pool(parent_path, pool_path):
+                return None
+        else:
+            print(f"Fetching {parent_name} into its object pool...")
+            with accounted_size(pool_path):
+                return_code, _, messages = run_git(['git', 'fetch', '--progress', '--tags', parent_url, '+refs/heads/*:refs/heads/*'], pool_path)
+            if return_code != 0:
+                print(f"Could not fetch {parent_name} into its object pool: {' '.join(messages)}")
+                return None
+        fetched_pools.add(pool_path)
+    return pool_path
+
+def mirror_repo(repo, repo_path):
+    # Keep the repository as a bare mirror. Forks, and parents that already
+    # have a pool, borrow objects from the fork network's pool.
+    pool_path = None
+    own_pool_path = get_pool_path(repo.full_name)
+    if repo.fork and repo.parent and repo.parent_url:
+        pool_path = prepare_object_pool(repo.parent, repo.parent_url)
+    elif os.path.exists(own_pool_path):
+        pool_path = own_pool_path
+
+    with get_pool_lock(own_pool_path):
+        if is_git_repo(repo_path):
+            print(f"Updating mirror of {repo.full_name}...")
+            return_code, _, messages = run_git(['git', 'fetch', '--progress', '--prune', 'origin'], repo_path)
+            status = 'updated'
+        else:
+            os.makedirs(os.path.dirname(repo_path), exist_ok=True)
+            git_command = ['git', 'clone', '--progress', '--mirror', repo.clone_url, repo_path]
+            if pool_path:
+                git_command[3:3] = ['--reference', pool_path]
+            print(f"Executing command: {' '.join(git_command)}")
+            mark_in_flight(repo_path, repo.full_name)
+            try:
+                return_code, _, messages = run_git(git_command, os.path.dirname(repo_path))
+            finally:
+                clear_in_flight(repo_path)
+            status = 'cloned'
+        # A parent of forks hands what it just fetched on to their pool,
+        # which then needs no fetch from the network in this run
+        if return_code == 0 and os.path.exists(own_pool_path) and share_with_pool(repo_path, own_pool_path):
+            fetched_pools.add(own_pool_path)
+
+    if return_code != 0:
+        sys.stderr.write(f"Error: Mirroring {repo.full_name} failed (Exit Code: {return_code}): {' '.join(messages)}\n")
         if exitOnERR:
             sys.exit()
+        return 'failed'
+    print(f"Success: {repo.full_name} mirrored into '{repo_path}'")
+    return status
+
+# Admission of new clones by estimated size: a clone only starts when the
+# volume keeps MIN_FREE_SPACE free, the run stays within its transfer
+# budget and the archive within its quota. Near the quota, clones are
+# downgraded to cheaper strategies (or skipped, per QUOTA_POLICY). Estimates
+# come from the API's repository size and are deliberately rough.
+STRATEGY_SIZE_FACTORS = {'full': 1.0, 'mirror': 1.0, 'single-branch': 0.8, 'treeless': 0.5, 'blobless': 0.3, 'shallow': 0.1}
+# Working copies also hold a checkout of the default branch
+CHECKOUT_SIZE_FACTOR = 0.5
+DOWNGRADE_ORDER = ['full', 'single-branch', 'treeless', 'blobless', 'shallow']
+# Repositories held back for ordering by size
+SIZE_ORDER_WINDOW = 500
+
+disk_condition = threading.Condition()
+reserved_disk = 0
+reserved_transfer = 0
+spent_transfer = 0
+archive_usage = None
+
+def estimate_clone_size(repo_size, strategy):
+    if not repo_size:
+        return 0
+    checkout = 0 if strategy == 'mirror' else CHECKOUT_SIZE_FACTOR
+    return int(repo_size * 1024 * (STRATEGY_SIZE_FACTORS.get(strategy, 1.0) + checkout))
+
+def get_disk_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+def get_archive_usage():
+    # Called with disk_condition held. Repositories without a recorded size
+    # (synced before sizes were recorded, or migrated from the legacy
+    # state) are measured on disk. Object pools and the repository cache
+    # belong to no repository and are measured as a whole.
+    global archive_usage
+    if archive_usage is None:
+        archive_usage = get_disk_size(f"{original_dir}/{OBJECT_POOLS_DIR}") + get_disk_size(f"{original_dir}/{REPO_CACHE_DIR}")
+        for name, metadata in load_cloned_repos().items():
+            if metadata.get('status') == 'failed':
+                continue
+            if metadata.get('disk_size') is not None:
+                archive_usage += metadata['disk_size']
+            else:
+                repo_path = get_recorded_path(name)
+                if repo_path and is_git_repo(repo_path):
+                    archive_usage += get_disk_size(repo_path)
+    return archive_usage
+
+def admit_clone(repo, strategy, replaced=0):
+    # Reserve room for a new clone. Returns the strategy to clone with and
+    # the reserved bytes; the strategy is None when the clone has to wait
+    # for a later run. replaced is the size of a copy the clone replaces,
+    # which is only deleted once the clone is admitted.
+    global reserved_disk, reserved_transfer
+    candidates = [strategy]
+    if QUOTA_POLICY == 'downgrade' and strategy in DOWNGRADE_ORDER:
+        candidates += DOWNGRADE_ORDER[DOWNGRADE_ORDER.index(strategy) + 1:]
+    with disk_condition:
+        while True:
+            if ARCHIVE_QUOTA is not None:
+                usage = get_archive_usage() + reserved_disk - replaced
+                fitting = [candidate for candidate in candidates if usage + estimate_clone_size(repo.size, candidate) <= ARCHIVE_QUOTA]
+                if not fitting:
+                    print(f"Not cloning {repo.full_name}: it would exceed the archive quota.")
+                    count_metric('quota_skips')
+                    return None, 0
+                chosen = fitting[0]
+            else:
+                chosen = strategy
+            size = estimate_clone_size(repo.size, chosen)
+            if TRANSFER_BUDGET is not None and spent_transfer + reserved_transfer + size > TRANSFER_BUDGET:
+                print(f"Not cloning {repo.full_name}: it would exceed the transfer budget of this run.")
+                count_metric('budget_skips')
+                return None, 0
+            if size <= shutil.disk_usage(original_dir).free + replaced - MIN_FREE_SPACE - reserved_disk:
+                reserved_disk += size
+                reserved_transfer += size
+                if chosen != strategy:
+                    print(f"Archive quota is near, cloning {repo.full_name} as {chosen} instead of {strategy}.")
+                    count_metric('quota_downgrades')
+                return chosen, size
+            if not reserved_disk:
+                print(f"Not cloning {repo.full_name}: not enough free disk space (about {size / SIZE_UNITS['MiB']:.0f} MiB needed).")
+                count_metric('disk_skips')
+                return None, 0
+            # Clones in flight reserved their estimated size; once they are
+            # done their real size is known
+            disk_condition.wait()
+
+def release_clone(size, transfer_bytes=0, disk_size_change=0):
+    # Swap a sync's reservation for what it really fetched and stored, in
+    # one step so that waiting clones are never admitted against neither
+    global reserved_disk, reserved_transfer
+    with disk_condition:
+        reserved_disk -= size
+        reserved_transfer -= size
+        account_sync(transfer_bytes, disk_size_change)
+
+def account_sync(transfer_bytes, disk_size_change):
+    # disk_condition is reentrant, release_clone calls this holding it
+    global spent_transfer, archive_usage
+    with disk_condition:
+        spent_transfer += transfer_bytes
+        if ARCHIVE_QUOTA is not None:
+            archive_usage = get_archive_usage() + disk_size_change
+        disk_condition.notify_all()
+
+@contextlib.contextmanager
+def accounted_size(path, suffix=''):
+    # Count what a pool or repository cache entry grows or shrinks by, as no
+    # repository's recorded size covers it. Wikis are not measured, so
+    # moving them in and out of the cache leaves the usage as it is.
+    if ARCHIVE_QUOTA is None or suffix:
+        yield
         return
+    before = get_disk_size(path)
+    try:
+        yield
+    finally:
+        account_sync(0, get_disk_size(path) - before)
+
+def order_by_size(repos):
+    # Hand out the smallest repository listed so far each time a worker
+    # asks for the next one, while the listing keeps running. At most
+    # SIZE_ORDER_WINDOW repositories are held, so the order is only
+    # approximate: a small repository listed late still comes after large
+    # ones handed out before it was listed.
+    heap = []
+    condition = threading.Condition()
+    state = {'done': False, 'error': None}
+
+    def collect():
+        try:
+            for seq, repo in enumerate(repos):
+                with condition:
+                    while len(heap) >= SIZE_ORDER_WINDOW:
+                        condition.wait()
+                    heapq.heappush(heap, (repo.size or 0, seq, repo))
+                    condition.notify_all()
+        except Exception as e:
+            state['error'] = e
+        finally:
+            with condition:
+                state['done'] = True
+                condition.notify_all()
+
+    threading.Thread(target=collect, name='work-order', daemon=True).start()
+    while True:
+        with condition:
+            while not heap and not state['done']:
+                condition.wait()
+            if not heap:
+                break
+            repo = heapq.heappop(heap)[2]
+            condition.notify_all()
+        yield repo
+    if state['error']:
+        raise state['error']
 
-    print(f"\nProcessing {len(starred_repos)} repositories...")
+def get_wiki_strategy():
+    # Wikis are small, so they are cloned in full unless a fixed strategy was asked for
+    return 'full' if CLONE_STRATEGY == 'auto' or mirrorMode else CLONE_STRATEGY
 
-    # Loop through each starred repo and clone it
-    for i, repo in enumerate(starred_repos, start=1):
-        repo_url = repo['clone_url']
-        repo_name = repo['full_name']  # Repo in format "owner/repo"
-        language = repo['language']  # Get the language of the repo
-        repo_size = repo['size']  # Size of the repository in KB
-        owner = repo['owner']['login']  # Get the owner of the repo
+def sync_repo(i, repo):
+    repo_url = repo.clone_url
+    repo_name = repo.full_name  # Repo in format "owner/repo"
+    language = repo.language  # Get the language of the repo
+    repo_size = repo.size  # Size of the repository in KB
+    owner = repo.owner  # Get the owner of the repo
 
+    if repo_output is not None:
+        repo_output.begin()
+    transfer_stats.current = []
+    try:
         # Display detailed info about the current repository
-        print(f"\nProcessing repository {i}/{len(starred_repos)}:")
+        print(f"\nProcessing repository {i}:")
         print(f"  - Repository Name: {repo_name}")
         print(f"  - Clone URL: {repo_url}")
         print(f"  - Language: {language if language else 'Unknown'}")
         print(f"  - Repository Size: {repo_size} KB")
         print(f"  - Owner: {owner}")
 
-        clone_repo(repo_url, repo_name, language, owner)
-        clone_repo_with_wiki(repo_url, repo_name, language, owner)
+        folder_name = f"{owner}@{repo_name.split('/')[-1]}"
+        repo_path = get_repo_path(repo)
+        if incrementalSync and is_repo_unchanged(folder_name, repo, repo_path):
+            print(f"{folder_name} has not changed since its last sync, skipping.")
+            # Wiki edits do not change pushed_at, so the wiki is still checked
+            with timed_phase('wiki', repo_name):
+                wiki_status = sync_wiki(repo, folder_name, get_wiki_strategy())
+            fields = get_wiki_fields(wiki_status)
+            if (get_cloned_repo(folder_name) or {}).get('sources') != repo.sources:
+                fields['sources'] = repo.sources
+            if fields:
+                update_cloned_repo(folder_name, **fields)
+            mark_completed(repo_name)
+            return 'unchanged', wiki_status
+
+        if repo.disabled:
+            print(f"{repo_name} is disabled on GitHub, skipping.")
+            mark_completed(repo_name)
+            return 'skipped', None
+
+        wiki_path = f"{original_dir}/{language or 'Unknown'}/{folder_name}-Wiki"
+        if is_other_repo(get_cloned_repo(folder_name), repo):
+            displace_repo(folder_name)
+
+        # Parts that failed verification are cloned again. A broken
+        # repository stays until its new clone is admitted.
+        broken = (get_cloned_repo(folder_name) or {}).get('broken', [])
+        rebuild = 'repo' in broken and is_git_repo(repo_path)
+        if 'wiki' in broken and os.path.exists(wiki_path):
+            print(f"{wiki_path} failed verification, cloning it again.")
+            shutil.rmtree(wiki_path)
+
+        started = time.monotonic()
+        restored = False
+        if not rebuild and not is_git_repo(repo_path):
+            # Moved or cached copies only need an update
+            if relocate_repo(repo, folder_name, repo_path):
+                print(f"{repo_name} was moved from its previous location.")
+            else:
+                restored = restore_from_cache(repo.id, repo_path, repo_url)
+        phase = 'update' if is_git_repo(repo_path) and not rebuild else 'clone'
+        if mirrorMode:
+            strategy = 'mirror'
+        else:
+            recorded_strategy = None
+            if phase == 'update':
+                # Clones made before strategies were recorded are shallow when git says so
+                metadata = get_cloned_repo(folder_name) or {}
+                recorded_strategy = metadata.get('strategy') or ('shallow' if os.path.exists(f'{repo_path}/.git/shallow') else None)
+            strategy = choose_clone_strategy(repo_size, recorded_strategy)
+        reserved = 0
+        if phase == 'clone':
+            replaced = ((get_cloned_repo(folder_name) or {}).get('disk_size') or 0) if rebuild else 0
+            strategy, reserved = admit_clone(repo, strategy, replaced)
+            if strategy is None:
+                return 'deferred', None
+        repo_bytes, disk_size_change = 0, 0
+        try:
+            if rebuild:
+                print(f"{repo_path} failed verification, cloning it again.")
+                shutil.rmtree(repo_path)
+                # The new clone is measured afresh
+                update_cloned_repo(folder_name, disk_size=None)
+                account_sync(0, -replaced)
+            with timed_phase(phase, repo_name):
+                if mirrorMode:
+                    status = mirror_repo(repo, repo_path)
+                else:
+                    status = clone_repo(repo_url, repo_name, language, owner, strategy, repo.default_branch)
+            repo_bytes = sum(stats.get('received_bytes', 0) for stats in transfer_stats.current)
+
+            # Sizes only serve the quota, so without one nothing is walked.
+            # New clones are measured, updates grow by what they fetched.
+            previous_disk_size = (get_cloned_repo(folder_name) or {}).get('disk_size')
+            if ARCHIVE_QUOTA is None:
+                disk_size = previous_disk_size
+            elif status == 'cloned' or restored or (previous_disk_size is None and is_git_repo(repo_path)):
+                disk_size = get_disk_size(repo_path)
+            elif is_git_repo(repo_path):
+                disk_size = previous_disk_size + repo_bytes
+            else:
+                disk_size = 0
+            disk_size_change = (disk_size or 0) - (previous_disk_size or 0)
+        finally:
+            release_clone(reserved, repo_bytes, disk_size_change)
+        if status == 'blocked':
+            # Someone else's directory sits where the clone goes; nothing
+            # is recorded so that it is never taken for ours
+            return status, None
+        if restored and status == 'updated':
+            status = 'restored'
+        with timed_phase('wiki', repo_name):
+            wiki_status = sync_wiki(repo, folder_name, get_wiki_strategy())
+        # Wikis are not admitted nor measured; they count by what they fetched
+        wiki_bytes = sum(stats.get('received_bytes', 0) for stats in transfer_stats.current) - repo_bytes
+        if wiki_bytes:
+            account_sync(wiki_bytes, wiki_bytes)
+
+        # Summarize what git reported for this repository's transfers
+        transfer = {
+            'bytes': sum(stats.get('received_bytes', 0) for stats in transfer_stats.current),
+            'objects': sum(stats.get('received_objects', 0) for stats in transfer_stats.current),
+            'seconds': round(sum(stats.get('duration', 0) for stats in transfer_stats.current), 3),
+        }
+        count_metric('transfer_bytes', transfer['bytes'])
+        count_metric('transfer_objects', transfer['objects'])
+        record_metric('repo', repo=repo_name, status=status, wiki=wiki_status, strategy=strategy,
+                      duration=round(time.monotonic() - started, 3), transfer=transfer)
+        if transfer['objects']:
+            print(f"Transferred {transfer['objects']} objects ({transfer['bytes'] / SIZE_UNITS['MiB']:.2f} MiB) in {transfer['seconds']:.1f}s")
+
+        # Record the outcome in the clone state journal
+        save_cloned_repo(
+            folder_name,
+            id=repo.id,
+            full_name=repo_name,
+            path=os.path.relpath(repo_path, original_dir),
+            status=status,
+            pushed_at=repo.pushed_at,
+            updated_at=repo.updated_at,
+            size=repo_size,
+            default_branch=repo.default_branch,
+            archived=repo.archived,
+            commit=get_head_commit(repo_path) if status != 'failed' else None,
+            wiki=is_git_repo(wiki_path),
+            strategy=strategy if is_git_repo(repo_path) else None,
+            disk_size=disk_size,
+            parent=repo.parent,
+            sources=repo.sources,
+            transfer=transfer,
+            **get_wiki_fields(wiki_status),
+            **({'broken': []} if broken else {}),
+            clone_failed=phase == 'clone' and status == 'failed',
+        )
+        if status != 'failed':
+            mark_completed(repo_name)
+    finally:
+        del transfer_stats.current
+        if repo_output is not None:
+            repo_output.end()
+    return status, wiki_status
+
+# Verification: repositories changed since they were last verified get the
+# cheap checks (refs readable, HEAD resolvable, object connectivity); a
+# random sample of the others gets the connectivity check again. Anything
+# that fails is confirmed with a full fsck and, when broken, marked in the
+# state so that the next sync clones it again; VERIFY_SAMPLE sets the sample.
+
+def get_git_dir(repo_path):
+    return f'{repo_path}/.git' if os.path.isdir(f'{repo_path}/.git') else repo_path
+
+def get_change_time(repo_path):
+    # Latest modification of the parts of a repository that a fetch,
+    # checkout or clone touches
+    git_dir = get_git_dir(repo_path)
+    change_time = 0.0
+    for name in ('', 'HEAD', 'FETCH_HEAD', 'packed-refs', 'shallow', 'objects/pack', 'refs/heads', 'refs/tags', 'refs/remotes/origin'):
+        try:
+            change_time = max(change_time, os.stat(f'{git_dir}/{name}').st_mtime)
+        except OSError:
+            pass
+    return change_time
+
+def find_archived_repos():
+    # Every repository (and wiki) in the language directories, as
+    # (path, state name, part) with part 'repo' or 'wiki'
+    archived = []
+    for language in sorted(os.listdir(original_dir)):
+        language_dir = f'{original_dir}/{language}'
+        if language.startswith('.') or language == CACHE_DIR or not os.path.isdir(language_dir):
+            continue
+        for folder in sorted(os.listdir(language_dir)):
+            repo_path = f'{language_dir}/{folder}'
+            if not os.path.isdir(repo_path) or not is_git_repo(repo_path):
+                continue
+            if folder.endswith('-Wiki'):
+                archived.append((repo_path, folder[:-len('-Wiki')], 'wiki'))
+            else:
+                archived.append((repo_path, folder.removesuffix('.git') if mirrorMode else folder, 'repo'))
+    return archived
+
+def run_check(command, repo_path):
+    proc = subprocess.run(command, cwd=repo_path, capture_output=True, text=True)
+    return proc.returncode == 0, proc.stderr.strip()
+
+def check_repo(repo_path):
+    # Cheap checks first; returns None when they pass, else what failed
+    proc = subprocess.run(['git', 'for-each-ref', '--format=%(objectname) %(refname)'], cwd=repo_path, capture_output=True, text=True)
+    if proc.returncode != 0:
+        return f"unreadable refs: {proc.stderr.strip()}"
+    # Empty repositories have nothing for HEAD to point at
+    if proc.stdout.strip():
+        ok, _ = run_check(['git', 'rev-parse', '--verify', '--quiet', 'HEAD^{commit}'], repo_path)
+        if not ok:
+            return "HEAD does not resolve to a commit"
+    ok, error = run_check(['git', 'fsck', '--connectivity-only', '--no-dangling', '--no-progress'], repo_path)
+    if not ok:
+        return f"connectivity check failed: {error}"
+    return None
+
+def verify_repo(repo_path, name, part):
+    # Returns (status, problem) with status 'ok' or 'broken'
+    with timed_phase('verify', name):
+        problem = check_repo(repo_path)
+        if problem:
+            print(f"{repo_path}: {problem}; running a full fsck...")
+            ok, error = run_check(['git', 'fsck', '--full', '--no-dangling', '--no-progress'], repo_path)
+            if ok:
+                problem = None
+            else:
+                problem = f"{problem}\n{error}"
+    count_metric('repos_verified')
+    fields = {f'{part}_verified_at': datetime.now().isoformat(timespec='seconds')}
+    if problem:
+        count_metric('repos_broken')
+        broken = set((get_cloned_repo(name) or {}).get('broken', []))
+        fields['broken'] = sorted(broken | {part})
+    if get_cloned_repo(name) is not None:
+        update_cloned_repo(name, **fields)
+    elif problem:
+        print(f"{repo_path} is not in {CLONED_REPOS_FILE}; remove it by hand to clone it again.")
+    return ('broken' if problem else 'ok'), problem
+
+def is_verified(repo_path, name, part):
+    # Verified since the repository last changed
+    verified_at = (get_cloned_repo(name) or {}).get(f'{part}_verified_at')
+    if not verified_at:
+        return False
+    return datetime.fromisoformat(verified_at).timestamp() >= get_change_time(repo_path)
+
+def verify_archive():
+    print(f"\nVerifying repositories under {original_dir}...")
+    metadata = load_cloned_repos()
+    archived = find_archived_repos()
+    work = []
+    skipped = 0
+    for repo_path, name, part in archived:
+        record = metadata.get(name) or {}
+        changed = record.get('status') == 'failed' or part in record.get('broken', []) or not is_verified(repo_path, name, part)
+        if changed or random.random() < VERIFY_SAMPLE:
+            work.append((repo_path, name, part))
+        else:
+            skipped += 1
+    jobs = args.jobs or os.cpu_count() or 1
+    print(f"Checking {len(work)} of {len(archived)} repositories with {jobs} worker(s), {skipped} unchanged since their last verification.")
+
+    results = {'ok': 0, 'broken': 0}
+    broken = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(verify_repo, *item): item for item in work}
+        for future in as_completed(futures):
+            status, problem = future.result()
+            results[status] += 1
+            if problem:
+                broken.append(futures[future][0])
+                sys.stderr.write(f"Error: {futures[future][0]} is broken: {problem}\n")
+
+    print(f"\nVerified: {results['ok']} ok, {results['broken']} broken, {skipped} skipped.")
+    for repo_path in sorted(broken):
+        print(f"  - {repo_path} (will be cloned again on the next sync)")
+    print_metrics_summary()
+    record_metric('verify', repos=len(archived), checked=len(work), skipped=skipped, broken=len(broken))
+    if PROMETHEUS_FILE:
+        write_prometheus_metrics()
+
+def load_cached_listing(source):
+    # A source's listing as cached by the last sync, None when a page is
+    # missing. Repository lists are read as they are, without metadata.
+    if source.startswith('list:'):
+        return [StarredRepo(full_name=repo_name, owner=repo_name.split('/')[0])
+                for repo_name in read_repo_list(source.split(':', 1)[1])]
+    cached = load_cached_response(get_listing_url(source))
+    if cached is None:
+        return None
+    pages = [cached]
+    links = get_link_urls(cached['headers'])
+    if 'last' in links:
+        last_page = int(parse_qs(urlparse(links['last']).query).get('page', ['1'])[0])
+        if API_PAGES != -1:
+            last_page = min(last_page, API_PAGES)
+        for page in range(2, last_page + 1):
+            cached = load_cached_response(get_page_url(links['last'], page))
+            if cached is None:
+                return None
+            pages.append(cached)
+    else:
+        while 'next' in links and (API_PAGES == -1 or len(pages) < API_PAGES):
+            cached = load_cached_response(links['next'])
+            if cached is None:
+                return None
+            pages.append(cached)
+            links = get_link_urls(cached['headers'])
+    return [StarredRepo.from_api(data) for page in pages for data in json.loads(page['body'])]
+
+def plan_sync():
+    # Dry run: compare the listings cached by the last sync with the local
+    # state, without network access or git
+    print(f"\nPlanning sync for: {', '.join(SOURCES)}")
+    # Loaded first and read-only, so that later lookups reuse it
+    repos = load_cloned_repos(read_only=True)
+    listed = {}
+    complete = True
+    for source in SOURCES:
+        listing = load_cached_listing(source)
+        if listing is None:
+            print(f"No complete cached listing for {source}, run a sync first.")
+            complete = False
+            continue
+        for repo in listing:
+            listed.setdefault(repo.full_name, repo)
+
+    plan = {'new': [], 'changed': [], 'moved': [], 'unchanged': [], 'removed': []}
+    for repo in listed.values():
+        folder_name = f"{repo.owner}@{repo.full_name.split('/')[-1]}"
+        metadata = repos.get(folder_name)
+        if is_other_repo(metadata, repo):
+            metadata = None
+        if metadata is None and repo.id is not None:
+            metadata = repos.get(cloned_repo_ids.get(repo.id))
+        repo_path = get_repo_path(repo)
+        if metadata is None:
+            plan['new'].append(repo.full_name)
+        elif repo.clone_url is None:
+            # Repository list entries carry nothing to compare
+            plan['unchanged'].append(repo.full_name)
+        elif metadata.get('path') and metadata['path'] != os.path.relpath(repo_path, original_dir):
+            plan['moved'].append(f"{repo.full_name}: {metadata['path']} -> {os.path.relpath(repo_path, original_dir)}")
+        elif is_repo_unchanged(folder_name, repo, repo_path):
+            plan['unchanged'].append(repo.full_name)
+        else:
+            plan['changed'].append(repo.full_name)
+    if complete:
+        listed_ids = {repo.id for repo in listed.values() if repo.id is not None}
+        plan['removed'] = [repos[name]['full_name'] for name in find_removed_repos(set(listed), listed_ids)]
+
+    print(f"\nPlan: {', '.join(f'{len(names)} {kind}' for kind, names in plan.items())}")
+    for kind, marker in (('new', '+'), ('changed', '~'), ('moved', '>'), ('removed', '-')):
+        if plan[kind]:
+            if kind == 'removed':
+                print(f"\nRemoved, to be {({'keep': 'kept', 'archive': 'archived', 'prune': 'pruned'})[REMOVED_POLICY]}:")
+            else:
+                print(f"\n{kind.capitalize()}:")
+            for name in sorted(plan[kind]):
+                print(f"  {marker} {name}")
+    if verboseOut and plan['unchanged']:
+        print("\nUnchanged:")
+        for name in sorted(plan['unchanged']):
+            print(f"    {name}")
+    if not complete:
+        print("\nRemoved repositories are only detected when every listing is cached.")
+
+# Repositories no longer listed by any source are moved here (keeping their
+# language directory) when REMOVED_POLICY is 'archive'. A repository listed
+# again is moved back from its recorded path.
+UNSTARRED_DIR = '.unstarred'
+
+def get_listed_repos():
+    # Names and IDs of every repository the sources list, or None when a
+    # listing is incomplete: a page failed or --apages cut it short
+    names, ids = set(), set()
+    for source in SOURCES:
+        listing = get_listing_checkpoint(source)
+        if source.startswith('list:'):
+            if 1 not in listing['pages']:
+                return None
+            names.update(read_repo_list(source.split(':', 1)[1]))
+        elif API_PAGES != -1 or not listing['last_page'] or any(page not in listing['pages'] for page in range(1, listing['last_page'] + 1)):
+            return None
+        for page in listing['pages']:
+            for repo in load_listing_page(source, page):
+                names.add(repo.full_name)
+                if repo.id is not None:
+                    ids.add(repo.id)
+    return names, ids
+
+def find_removed_repos(listed_names, listed_ids):
+    # State names of repositories no longer listed, matched by ID so that
+    # renamed and transferred ones are not taken for removed. Only
+    # repositories whose recorded sources were all listed in this run
+    # count; another source may still list the others.
+    removed = []
+    for name, metadata in load_cloned_repos().items():
+        if not metadata.get('full_name') or metadata['full_name'] in listed_names or metadata.get('id') in listed_ids:
+            continue
+        if metadata.get('status') == 'archived' and REMOVED_POLICY != 'prune':
+            continue
+        if not metadata.get('sources') or set(metadata['sources']) <= set(SOURCES):
+            removed.append(name)
+    return removed
+
+def get_recorded_path(repo_name):
+    # Where a repository in the state lives; records from before paths were
+    # kept are looked up in the language directories
+    metadata = get_cloned_repo(repo_name) or {}
+    if metadata.get('path'):
+        return f"{original_dir}/{metadata['path']}"
+    matches = glob.glob(f"{original_dir}/*/{glob.escape(repo_name)}{'.git' if mirrorMode else ''}")
+    return matches[0] if matches else None
 
+def reconcile_removed_repos():
+    # Archive or prune repositories the sources no longer list, per
+    # REMOVED_POLICY. Pruned repositories keep their git directory in the
+    # repository cache, so starring them again does not clone from scratch.
+    listed = get_listed_repos()
+    if listed is None:
+        print("\nSome listings are incomplete, repositories no longer listed are left alone.")
+        return
+    removed = find_removed_repos(*listed)
+    if not removed:
+        return
+    if REMOVED_POLICY == 'keep':
+        print(f"\n{len(removed)} repositories are no longer listed and are kept (see --removed-policy).")
+        return
+    print(f"\n{'Archiving' if REMOVED_POLICY == 'archive' else 'Pruning'} {len(removed)} repositories that are no longer listed...")
+    for repo_name in removed:
+        metadata = get_cloned_repo(repo_name)
+        repo_path = get_recorded_path(repo_name)
+        wiki_path = f"{os.path.dirname(repo_path)}/{repo_name}-Wiki" if repo_path else None
+        if REMOVED_POLICY == 'archive':
+            if repo_path is None or not is_git_repo(repo_path):
+                forget_cloned_repo(repo_name)
+                continue
+            archive_path = f"{original_dir}/{UNSTARRED_DIR}/{os.path.relpath(repo_path, original_dir)}"
+            if os.path.exists(archive_path):
+                sys.stderr.write(f"Error: {archive_path} already exists, leaving {repo_path} in place\n")
+                continue
+            print(f"Archiving {metadata['full_name']} into {os.path.dirname(archive_path)}")
+            os.renames(repo_path, archive_path)
+            archive_wiki_path = f"{os.path.dirname(archive_path)}/{repo_name}-Wiki"
+            if os.path.exists(wiki_path) and not os.path.exists(archive_wiki_path):
+                os.renames(wiki_path, archive_wiki_path)
+            update_cloned_repo(repo_name, status='archived', path=os.path.relpath(archive_path, original_dir))
+            count_metric('repos_archived')
+        else:
+            print(f"Pruning {metadata['full_name']}")
+            for path, suffix in ((repo_path, ''), (wiki_path, '.wiki')):
+                if path and os.path.exists(path) and not stash_repo(metadata.get('id'), path, suffix):
+                    # Without an ID there is no cache entry to come back to
+                    shutil.rmtree(path)
+            forget_cloned_repo(repo_name)
+            account_sync(0, -(metadata.get('disk_size') or 0))
+            count_metric('repos_pruned')
+
+def evict_repo_cache():
+    # Drop git directories that have sat in the repository cache for longer
+    # than REPO_CACHE_MAX_AGE
+    cache_dir = f"{original_dir}/{REPO_CACHE_DIR}"
+    if not os.path.isdir(cache_dir):
+        return
+    for entry in os.listdir(cache_dir):
+        cache_path = f"{cache_dir}/{entry}"
+        if time.time() - os.path.getmtime(cache_path) > REPO_CACHE_MAX_AGE:
+            print(f"Evicting {entry} from the repository cache")
+            shutil.rmtree(cache_path, ignore_errors=True)
+
+def print_summary(results, total):
+    counts = {}
+    for status, wiki_status in results:
+        counts[status] = counts.get(status, 0) + 1
+        if wiki_status:
+            counts[f'wiki {wiki_status}'] = counts.get(f'wiki {wiki_status}', 0) + 1
+    summary = ', '.join(f"{key}: {value}" for key, value in sorted(counts.items()))
+    print(f"[{len(results)}/{total}] {summary}")
+
+def run_sync():
+    print(f"\nStarting process for: {', '.join(SOURCES)}")
+
+    if useCache:
+        evict_cache()
+
+    if load_checkpoint():
+        listed_pages = sum(len(listing['pages']) for listing in checkpoint['listings'].values())
+        print(f"Resuming interrupted run: {listed_pages} listing page(s) and {len(checkpoint['completed'])} repositories already done.")
+        discard_partial_clones()
+    
+    print(f"\nProcessing repositories with {JOBS} worker(s) as they are listed...")
+
+    # Clone or update each starred repo in the worker pool while the listing
+    # is still being fetched, keeping only a bounded number of repositories
+    # queued ahead of the workers
+    results = []
+    executor = ThreadPoolExecutor(max_workers=JOBS)
+    pending = set()
+    total = 0
+    try:
+        for total, repo in enumerate(order_by_size(get_work_set()), start=1):
+            pending.add(executor.submit(sync_repo, total, repo))
+            if len(pending) >= JOBS * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results.append(future.result())
+                    if repo_output is not None:
+                        print_summary(results, total)
+        for future in as_completed(pending):
+            results.append(future.result())
+            if repo_output is not None:
+                print_summary(results, total)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        save_checkpoint()
+
+    if not total and not checkpoint['completed']:
+        sys.stderr.write("No repositories found or error fetching data.\n")
+        if exitOnERR:
+            sys.exit()
+        return
+
+    reconcile_removed_repos()
+    evict_repo_cache()
+
+    print("\nSummary:")
+    print_summary(results, total)
+    print_metrics_summary()
+    record_metric('run', repos=total, phases={phase: round(seconds, 3) for phase, (_, seconds) in phase_metrics.items()}, **counter_metrics)
+    if PROMETHEUS_FILE:
+        write_prometheus_metrics()
+    remove_checkpoint()
     print("\nProcess completed. All repositories have been cloned.")
 
+def main(argv=None):
+    configure(parse_args(argv))
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'verify':
+        verify_archive()
+    elif args.plan:
+        plan_sync()
+    else:
+        load_http_stack()
+        run_sync()
+
 try:
     if __name__ == '__main__':
         main()
 except KeyboardInterrupt:
-    print('Exiting...')
+    print(f'Exiting... progress is kept in {CHECKPOINT_DIR}, run again to resume.')
 except Exception as e:
     sys.stderr.write(f"Sorry, something went wrong> {e}\n")
+    sys.exit(1)